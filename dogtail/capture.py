@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Background capture of the screen, for seeing what led up to a failure in a
+long-running script.
+
+With config.captureFrames set (or after startRecorder() is called), a
+FrameRecorder thread grabs the screen config.captureRate times a second and
+keeps the last config.captureSeconds seconds of it in memory. The frames are
+cut into tiles, and only the tiles that changed since the previous frame are
+kept, compressed, so an idle screen costs little more than the grabbing.
+
+When the script dies of an uncaught exception, or a dogtail.tc test case
+fails, the frames recorded since the last such dump are written to a new
+directory in config.scratchDir as numbered PNG files; call dumpFrames() to
+write them at any other point.
+
+The recorder grabs the screen through GDK from its own thread, so starting it
+makes dogtail take the GDK lock around its own uses of gtk.gdk (see
+dogtail.utils.enableGdkThreads); scripts that use gtk.gdk themselves while it
+runs should do the same.
+"""
+
+import os
+import time
+import zlib
+import threading
+import unittest
+from config import config
+from logging import debugLogger as logger
+from logging import TimeStamp
+import metrics
+
+class FrameBuffer:
+    """
+    Keeps up to maxFrames frames of RGB(A) pixels, each as the tiles that
+    changed since the frame before it. When the oldest frame is dropped, its
+    tiles are folded into a base frame, so that every frame still held can be
+    rebuilt.
+    """
+    tileSize = 64
+    compressLevel = 1
+
+    def __init__(self, maxFrames):
+        self.maxFrames = maxFrames
+        self.frames = []
+        self.baseSize = None
+        self.baseTiles = {}
+        self.checksums = {}
+        self.size = None
+        self.lock = threading.Lock()
+
+    def add(self, timestamp, width, height, channels, rowstride, pixels):
+        """
+        Add a frame of the given size, whose rows start every rowstride bytes
+        of pixels with channels bytes per pixel.
+        """
+        size = (width, height, channels)
+        if size != self.size:
+            self.checksums = {}
+            self.size = size
+        tiles = {}
+        for top in range(0, height, self.tileSize):
+            bottom = min(top + self.tileSize, height)
+            for left in range(0, width, self.tileSize):
+                start = left * channels
+                end = min(left + self.tileSize, width) * channels
+                rows = []
+                for y in range(top, bottom):
+                    offset = y * rowstride
+                    rows.append(pixels[offset + start:offset + end])
+                tile = ''.join(rows)
+                checksum = zlib.crc32(tile)
+                key = (left, top)
+                if self.checksums.get(key) != checksum:
+                    self.checksums[key] = checksum
+                    tiles[key] = zlib.compress(tile, self.compressLevel)
+        self.lock.acquire()
+        try:
+            self.frames.append((timestamp, size, tiles))
+            while len(self.frames) > self.maxFrames:
+                self.__dropOldest()
+        finally: self.lock.release()
+
+    def __dropOldest(self):
+        timestamp, size, tiles = self.frames.pop(0)
+        if size != self.baseSize:
+            self.baseSize = size
+            self.baseTiles = {}
+        self.baseTiles.update(tiles)
+
+    def iterFrames(self, since = 0):
+        """
+        Iterate over the frames taken at or after the given time, as
+        (timestamp, width, height, channels, pixels) tuples with the rows of
+        pixels packed one after another.
+        """
+        self.lock.acquire()
+        try:
+            frames = list(self.frames)
+            size = self.baseSize
+            tiles = dict(self.baseTiles)
+        finally: self.lock.release()
+        for timestamp, frameSize, frameTiles in frames:
+            if frameSize != size:
+                size = frameSize
+                tiles = {}
+            tiles.update(frameTiles)
+            if timestamp < since: continue
+            width, height, channels = size
+            yield (timestamp, width, height, channels,
+                    self.__assemble(width, height, channels, tiles))
+
+    def __assemble(self, width, height, channels, tiles):
+        rows = []
+        for top in range(0, height, self.tileSize):
+            bottom = min(top + self.tileSize, height)
+            tileRows = []
+            for left in range(0, width, self.tileSize):
+                tileWidth = (min(left + self.tileSize, width) - left) * channels
+                tile = zlib.decompress(tiles[(left, top)])
+                tileRows.append([tile[i:i + tileWidth]
+                    for i in range(0, len(tile), tileWidth)])
+            for y in range(bottom - top):
+                rows.append(''.join([tileRow[y] for tileRow in tileRows]))
+        return ''.join(rows)
+
+class FrameRecorder(threading.Thread):
+    """
+    Background thread which grabs the screen rate times a second into a
+    FrameBuffer holding the last seconds seconds of frames.
+    """
+    def __init__(self, rate, seconds):
+        threading.Thread.__init__(self, name = 'FrameRecorder')
+        self.setDaemon(True)
+        self.interval = 1.0 / rate
+        self.frames = FrameBuffer(max(1, int(rate * seconds)))
+        self.stopped = threading.Event()
+        self.start()
+
+    def run(self):
+        while not self.stopped.isSet():
+            start = time.time()
+            try: self.grab(start)
+            except Exception, e:
+                logger.log("Warning: Failed to capture the screen: %s" % e)
+                return
+            self.stopped.wait(max(0, self.interval - (time.time() - start)))
+
+    @metrics.timed('capture.frame')
+    def grab(self, timestamp):
+        """
+        Grab the screen into the FrameBuffer.
+        """
+        from utils import grabRegion
+        pixbuf = grabRegion()
+        self.frames.add(timestamp, pixbuf.get_width(), pixbuf.get_height(),
+                pixbuf.get_n_channels(), pixbuf.get_rowstride(),
+                pixbuf.get_pixels())
+
+    def stop(self):
+        """
+        Stop grabbing frames; the ones already grabbed are kept.
+        """
+        self.stopped.set()
+
+recorder = None
+
+def startRecorder(rate = None, seconds = None):
+    """
+    Start the FrameRecorder, if it isn't running yet, grabbing rate frames a
+    second (config.captureRate by default) and keeping the last seconds
+    seconds (config.captureSeconds by default).
+    """
+    global recorder
+    if recorder is not None and recorder.isAlive(): return recorder
+    if rate is None: rate = config.captureRate
+    if seconds is None: seconds = config.captureSeconds
+    from utils import enableGdkThreads
+    enableGdkThreads()
+    recorder = FrameRecorder(rate, seconds)
+    return recorder
+
+def stopRecorder():
+    """
+    Stop the FrameRecorder.
+    """
+    global recorder
+    if recorder is not None: recorder.stop()
+    recorder = None
+
+# The time of the last frame written by dumpFrames, so that a run of
+# failures doesn't write the same frames again and again.
+lastDumped = 0
+
+def dumpFrames(seconds = None, directory = None):
+    """
+    Write the frames grabbed in the last seconds seconds (all of them by
+    default) that haven't been written by an earlier call as PNG files to the
+    given directory, by default a new one in config.scratchDir, and return
+    the directory. Does nothing and returns None if the FrameRecorder isn't
+    running or there are no new frames.
+    """
+    global lastDumped
+    if recorder is None: return None
+    import gtk.gdk
+    since = 0
+    if seconds is not None: since = time.time() - seconds
+    frames = recorder.frames.iterFrames(max(since, lastDumped + 1e-6))
+    number = 0
+    for timestamp, width, height, channels, pixels in frames:
+        if not number:
+            if directory is None:
+                directory = os.path.join(config.scratchDir,
+                        TimeStamp().fileStamp('frames'))
+            if not os.path.isdir(directory): os.makedirs(directory)
+        lastDumped = timestamp
+        number += 1
+        pixbuf = gtk.gdk.pixbuf_new_from_data(pixels, gtk.gdk.COLORSPACE_RGB,
+                channels == 4, 8, width, height, width * channels)
+        fileName = "frame-%04d-%s.png" % (number,
+                time.strftime('%H%M%S', time.localtime(timestamp)))
+        pixbuf.save(os.path.join(directory, fileName), 'png')
+    if not number: return None
+    logger.log("%d captured frames written to %s" % (number, directory))
+    return directory
+
+class FrameBufferTests(unittest.TestCase):
+    def makeFrame(self, width, height, value):
+        return ''.join([chr((value + i) % 256) for i in range(width * height * 3)])
+
+    def testRoundTrip(self):
+        buffer = FrameBuffer(10)
+        frames = [self.makeFrame(100, 70, 0), self.makeFrame(100, 70, 0),
+                self.makeFrame(100, 70, 1), self.makeFrame(30, 20, 2)]
+        for i in range(len(frames)):
+            size = (100, 70)
+            if i == 3: size = (30, 20)
+            buffer.add(i, size[0], size[1], 3, size[0] * 3, frames[i])
+        self.assertEquals(len(buffer.frames[1][2]), 0)
+        self.assertEquals([frame[4] for frame in buffer.iterFrames()], frames)
+
+    def testRowstride(self):
+        buffer = FrameBuffer(1)
+        pixels = self.makeFrame(10, 10, 5)
+        padded = ''.join([pixels[i:i + 30] + 'xx' for i in range(0, 300, 30)])
+        buffer.add(0, 10, 10, 3, 32, padded)
+        self.assertEquals(list(buffer.iterFrames())[0][4], pixels)
+
+    def testDropOldest(self):
+        buffer = FrameBuffer(2)
+        frames = [self.makeFrame(130, 65, i) for i in range(5)]
+        for i in range(len(frames)):
+            buffer.add(i, 130, 65, 3, 130 * 3, frames[i])
+        self.assertEquals(len(buffer.frames), 2)
+        rebuilt = list(buffer.iterFrames())
+        self.assertEquals([frame[0] for frame in rebuilt], [3, 4])
+        self.assertEquals([frame[4] for frame in rebuilt], frames[3:])
+        self.assertEquals([frame[0] for frame in buffer.iterFrames(4)], [4])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,6 +32,16 @@ class _Config(object):
     typingDelay(float):
     The delay after a character is typed on the keyboard.
 
+    bulkTyping (boolean):
+    Whether typeText should resolve the whole string to keysyms first and
+    then send the key events in batches of typingBatchSize, with a single
+    typingDelay after each batch instead of after every character. With this
+    set, Node.typeText inserts the text through the EditableText interface
+    instead, when the node has one.
+
+    typingBatchSize (int):
+    The number of characters typed between delays when bulkTyping is set.
+
     runInterval(float):
     The interval at which dogtail.utils.run() and dogtail.procedural.run() 
     check to see if the application has started up.
@@ -49,12 +59,53 @@ class _Config(object):
     searchCutoffCount (int):
     Number of times to retry when a search fails.
 
+    searchStrategy (str):
+    The order in which Node.findChild walks the tree: 'dfs' (depth-first),
+    'bfs' (breadth-first) or 'iterative-deepening' (repeated depth-first
+    walks, one level deeper each time). With the latter two, nodes near the
+    top of the tree are found in time proportional to their depth, however
+    big the subtrees next to them are.
+
+    eventDrivenSearch (boolean):
+    Whether a failed search should wait for AT-SPI events announcing new or
+    renamed nodes, instead of sleeping and searching the whole tree again.
+    The total time spent waiting is the same as when retrying:
+    searchCutoffCount * searchBackoffDuration.
+
+    useSearchIndex (boolean):
+    Whether searches for predicates that filter on roleName and name should
+    look the nodes up in a per-application index, instead of walking the
+    whole tree. The index is built on the first such search in an
+    application, and kept up to date from AT-SPI events. findChild then
+    returns the first match the index holds, rather than working out which
+    match a walk in searchStrategy order would reach first; findChildren
+    still returns the matches in the order the walk would.
+
+    cacheProperties (boolean):
+    Whether to turn on pyatspi's property cache, which keeps the names,
+    roles, descriptions and child counts of the Accessibles it has seen up to
+    date from AT-SPI events, instead of asking the application each time.
+    When it is False, dogtail leaves pyatspi's cache level as it is.
+
     defaultDelay (float):
     Default time in seconds to sleep when delaying.
 
+    adaptiveDelays (boolean):
+    Whether delays (defaultDelay, actionDelay, typingDelay and the like)
+    should end as soon as the application being acted on goes quiet, i.e.
+    sends no AT-SPI events for quietPeriod seconds, instead of always lasting
+    their full length. They never last longer than the configured delay. The
+    time saved is written to the debug log.
+
+    quietPeriod (float):
+    How long in seconds an application must go without sending AT-SPI events
+    for adaptive delays to consider it quiet. Delays no longer than this
+    can't be shortened, so it should be well below typingDelay.
+
     childrenLimit (int):
     When there are a very large number of children of a node, only return
-    this many, starting with the first.
+    this many, starting with the first, from its children property. Searches
+    always look at all of the children.
 
     debugSearching (boolean):
     Whether to write info on search backoff and retry to the debug log.
@@ -70,6 +121,12 @@ class _Config(object):
     Whether we should identify nodes in the logs with long 'abcolute paths', or
     merely with a short 'relative path'. FIXME: give examples
 
+    cacheSearchPaths (boolean):
+    Whether Node.getAbsoluteSearchPath should remember the path it computed
+    for each node, reusing the paths of ancestors for their descendents.
+    Cached paths are dropped when AT-SPI events announce that a node on the
+    path was renamed or moved.
+
     ensureSensitivity (boolean):
     Should we check that ui nodes are sensitive (not 'greyed out') before
     performing actions on them? If this is True (the default) it will raise
@@ -80,6 +137,18 @@ class _Config(object):
     Whether we should write out debug information from the translation/i18n
     subsystem.
 
+    cachePackageDb (boolean):
+    Whether the answers to package database queries (versions, file lists,
+    dependencies and mo-files) should be saved in scratchDir at exit, for
+    later processes to use for as long as the package database is unchanged.
+    Within a process they are always cached.
+
+    cacheTranslations (boolean):
+    Whether the i18n module should load the translations of a set of mo-files
+    from an index file in scratchDir, built the first time that set is loaded
+    and rebuilt whenever one of the mo-files changes, instead of parsing every
+    mo-file in every process.
+
     blinkOnActions (boolean):
     Whether we should blink a rectangle around a Node when an action is
     performed on it.
@@ -96,8 +165,49 @@ class _Config(object):
     logDebugToFile (boolean):
     Whether to write debug output to a log file.
 
+    imageTolerance (int):
+    How much (0-255) a channel of a pixel may differ between two images for
+    dogtail.tc.TCImage to consider the pixel unchanged (default 0).
+
+    imageMaxDiffRatio (float):
+    The fraction of pixels that may differ by more than imageTolerance for
+    dogtail.tc.TCImage to consider two images the same (default 0.0).
+
+    useImageHashes (boolean):
+    Whether dogtail.tc.TCImage should keep a digest, a perceptual hash and a
+    thumbnail of each baseline file in dataDir, so that an image identical to
+    its baseline passes without the baseline being loaded.
+
+    captureFrames (boolean):
+    Whether importing dogtail.tree should start recording the screen in the
+    background, keeping the last captureSeconds seconds at captureRate frames
+    a second, to be written out when the script dies or a test case fails;
+    see dogtail.capture.
+
+    captureRate (float):
+    How many frames a second to record with captureFrames set (default 2).
+
+    captureSeconds (float):
+    How many seconds of frames to keep with captureFrames set (default 30).
+
     logDebugToStdOut (boolean):
     Whether to print log output to console or not (default True).
+
+    structuredResults (boolean):
+    Whether test case results should also be written to a JSON-lines file next
+    to the results log (with the same name plus '.jsonl'), one object per
+    result, for dogtail.logging.aggregateResults to combine across runs.
+
+    collectMetrics (boolean):
+    Whether to count searches, actions, key presses, delays and AT-SPI calls
+    and keep histograms of how long they take, written to the debug log at
+    exit; see dogtail.metrics.
+
+    asyncLogging (boolean):
+    Whether log entries should be written (and printed) by a background
+    thread, which flushes the log files once per batch of entries, instead of
+    by the code doing the logging. Everything queued is written when the
+    script exits, or dies of an uncaught exception.
     """
     def _getScriptName(self):
         return os.path.basename(sys.argv[0]).replace('.py','')
@@ -120,12 +230,20 @@ class _Config(object):
             # Timing and Limits
             'actionDelay' : 1.0,
             'typingDelay' : 0.075,
+            'bulkTyping' : False,
+            'typingBatchSize' : 16,
             'runInterval' : 0.5,
             'runTimeout' : 30,
             'searchBackoffDuration' : 0.5,
             'searchWarningThreshold' : 3,
             'searchCutoffCount' : 20,
+            'searchStrategy' : 'dfs',
+            'eventDrivenSearch' : False,
+            'useSearchIndex' : False,
+            'cacheProperties' : False,
             'defaultDelay' : 0.5,
+            'adaptiveDelays' : False,
+            'quietPeriod' : 0.03,
             'childrenLimit' : 100,
 
             # Debug
@@ -134,14 +252,26 @@ class _Config(object):
             'debugSearchPaths' : False,
             'logDebugToStdOut' : True,
             'absoluteNodePaths' : False,
+            'cacheSearchPaths' : False,
             'ensureSensitivity' : False,
             'debugTranslation' : False,
+            'cacheTranslations' : False,
+            'cachePackageDb' : False,
             'blinkOnActions' : False,
             'fatalErrors' : False,
             'checkForA11y' : True,
+            'imageTolerance' : 0,
+            'imageMaxDiffRatio' : 0.0,
+            'useImageHashes' : False,
+            'captureFrames' : False,
+            'captureRate' : 2.0,
+            'captureSeconds' : 30.0,
 
             # Logging
-            'logDebugToFile' : True
+            'logDebugToFile' : True,
+            'asyncLogging' : False,
+            'structuredResults' : False,
+            'collectMetrics' : False
     }
 
     options = {}
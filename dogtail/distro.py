@@ -5,7 +5,10 @@ __author__ = "Dave Malcolm <dmalcolm@redhat.com>, Zack Cerza <zcerza@redhat.com>
 
 import os
 import re
+import atexit
+import cPickle
 from version import Version
+from config import config
 from logging import debugLogger as logger
 
 class DistributionNotSupportedError(Exception):
@@ -33,11 +36,29 @@ class PackageDb:
     """
     Class to abstract the details of whatever software package database is in
     use (RPM, APT, etc)
+
+    databaseFiles lists the files that change whenever a package is installed
+    or removed; their modification times tell CachedPackageDb when the answers
+    it remembers have gone stale.
     """
+    databaseFiles = []
+
     def __init__(self):
         self.prefix = '/usr'
         self.localePrefixes = [self.prefix + '/share/locale']
 
+    def getDatabaseStamp(self):
+        """
+        Get a value that changes whenever the package database does, or None
+        if that can't be told.
+        """
+        if not self.databaseFiles: return None
+        stamp = []
+        for fileName in self.databaseFiles + self.localePrefixes:
+            try: stamp.append((fileName, os.stat(fileName).st_mtime))
+            except OSError: pass
+        return stamp
+
     def getVersion(self, packageName):
         """
         Method to get the version of an installed package as a Version 
@@ -54,6 +75,18 @@ class PackageDb:
         """
         raise NotImplementedError
 
+    def getFilesOfPackages(self, packageNames):
+        """
+        Method to get a list of the filenames owned by any of the packages,
+        skipping packages that aren't found. Subclasses can do this with a
+        single query.
+        """
+        result = []
+        for packageName in packageNames:
+            try: result.extend(self.getFiles(packageName))
+            except PackageNotFoundError: pass
+        return result
+
     def getMoFiles(self, locale = None):
         """
         Method to get a list of all .mo files on the system, optionally for a
@@ -82,40 +115,83 @@ class PackageDb:
         raise NotImplementedError
 
 class _RpmPackageDb(PackageDb):
+    databaseFiles = ['/var/lib/rpm/Packages', '/var/lib/rpm/rpmdb.sqlite']
+
     def __init__(self):
         PackageDb.__init__(self)
+        self.__ts = None
+        self.__providers = None
+        self.__stamp = None
 
-    def getVersion(self, packageName):
+    def __getTransactionSet(self):
+        """
+        Get a TransactionSet, opening a new one only if the database changed
+        since the last was opened. The map of providers is thrown away along
+        with it.
+        """
+        import rpm
+        stamp = self.getDatabaseStamp()
+        if self.__ts is None or stamp != self.__stamp:
+            self.__ts = rpm.TransactionSet()
+            self.__providers = None
+            self.__stamp = stamp
+        return self.__ts
+
+    def __getProviders(self):
+        """
+        Get a dictionary mapping everything provided by an installed package to
+        the names of the packages providing it, built by reading through the
+        whole database once instead of querying it for each requirement.
+        """
         import rpm
-        ts = rpm.TransactionSet()
+        ts = self.__getTransactionSet()
+        if self.__providers is None:
+            providers = {}
+            for header in ts.dbMatch():
+                name = header['name']
+                for provide in header[rpm.RPMTAG_PROVIDES]:
+                    providers.setdefault(provide, {})[name] = None
+            self.__providers = providers
+        return self.__providers
+
+    def getVersion(self, packageName):
+        ts = self.__getTransactionSet()
         for header in ts.dbMatch("name", packageName):
             return Version.fromString(header["version"])
         raise PackageNotFoundError, packageName
 
     def getFiles(self, packageName):
-        import rpm
-        ts = rpm.TransactionSet()
+        ts = self.__getTransactionSet()
         for header in ts.dbMatch("name", packageName):
             return header["filenames"]
         raise PackageNotFoundError, packageName
 
+    def getFilesOfPackages(self, packageNames):
+        ts = self.__getTransactionSet()
+        result = []
+        for packageName in packageNames:
+            for header in ts.dbMatch("name", packageName):
+                result.extend(header["filenames"])
+                break
+        return result
+
     def getDependencies(self, packageName):
         import rpm
-        ts = rpm.TransactionSet()
+        ts = self.__getTransactionSet()
         for header in ts.dbMatch("name", packageName):
             # Simulate a set using a hash (to a dummy value);
             # sets were only added in Python 2.4
             result = {}
+            providers = self.__getProviders()
 
             # Get the list of requirements; these are
             # sometimes package names, but can also be
             # so-names of libraries, and invented virtual
             # ids
             for requirement in header[rpm.RPMTAG_REQUIRES]:
-                # Get the name of the package providing
+                # Get the names of the packages providing
                 # this requirement:
-                for depPackageHeader in ts.dbMatch("provides", requirement):
-                    depName = depPackageHeader['name']
+                for depName in providers.get(requirement, {}).keys():
                     if depName!=packageName:
                         # Add to the Hash with a dummy value
                         result[depName]=None
@@ -123,6 +199,8 @@ class _RpmPackageDb(PackageDb):
         raise PackageNotFoundError, packageName
 
 class _AptPackageDb(PackageDb):
+    databaseFiles = ['/var/lib/dpkg/status']
+
     def __init__(self):
         PackageDb.__init__(self)
         self.cache = None
@@ -151,6 +229,18 @@ class _AptPackageDb(PackageDb):
                 if file: files.append(file)
             return files
 
+    def getFilesOfPackages(self, packageNames):
+        if not packageNames: return []
+        files = []
+        # dpkg lists the files of all the packages one after the other, and
+        # complains about unknown ones on stderr:
+        lines = os.popen('dpkg -L %s 2>/dev/null' % \
+                ' '.join(packageNames)).readlines()
+        for line in lines:
+            file = line.strip()
+            if file.startswith('/'): files.append(file)
+        return files
+
     def getDependencies(self, packageName):
         # Simulate a set using a hash (to a dummy value);
         # sets were only added in Python 2.4
@@ -179,6 +269,8 @@ class _UbuntuAptPackageDb(_AptPackageDb):
         self.localePrefixes.append(self.prefix + '/share/locale-langpack')
 
 class _PortagePackageDb(PackageDb):
+    databaseFiles = ['/var/db/pkg']
+
     def __init__(self):
         PackageDb.__init__(self)
 
@@ -199,6 +291,8 @@ class _PortagePackageDb(PackageDb):
         return Version.fromString(upstreamVersion);
 
 class _ConaryPackageDb(PackageDb):
+    databaseFiles = ['/var/lib/conarydb/conarydb']
+
     def __init__(self):
         PackageDb.__init__(self)
 
@@ -236,6 +330,86 @@ class JhBuildPackageDb(PackageDb):
                 result[line.strip()] = None
         return result.keys()
 
+class CachedPackageDb:
+    """
+    Wraps a PackageDb, remembering the answers to its queries for as long as
+    PackageDb.getDatabaseStamp() stays the same. If the PackageDb can't tell
+    when its database changes, nothing is cached.
+
+    With config.cachePackageDb set, the answers are saved in config.scratchDir
+    when the process exits, and picked up by the next process if the package
+    database hasn't changed in between.
+    """
+    def __init__(self, packageDb):
+        self.packageDb = packageDb
+        self.cacheFile = os.path.join(config.scratchDir,
+                'packagedb-%s.pickle' % packageDb.__class__.__name__)
+        self.__stamp = None
+        self.__answers = {}
+        self.__loaded = False
+        self.__changed = False
+
+    def __getattr__(self, name):
+        return getattr(self.packageDb, name)
+
+    def __load(self, stamp):
+        self.__loaded = True
+        if not config.cachePackageDb: return
+        atexit.register(self.save)
+        try:
+            cacheFile = open(self.cacheFile, 'rb')
+            try: savedStamp, answers = cPickle.load(cacheFile)
+            finally: cacheFile.close()
+        except Exception: return
+        if savedStamp == stamp:
+            self.__stamp = stamp
+            self.__answers = answers
+
+    def save(self):
+        """
+        Save the answers in config.scratchDir, if there are any new ones.
+        """
+        if not self.__changed: return
+        tempFile = "%s.%d" % (self.cacheFile, os.getpid())
+        try:
+            cacheFile = open(tempFile, 'wb')
+            try: cPickle.dump((self.__stamp, self.__answers), cacheFile, 2)
+            finally: cacheFile.close()
+            os.rename(tempFile, self.cacheFile)
+            self.__changed = False
+        except (IOError, OSError, cPickle.PicklingError):
+            logger.log("Warning: Failed to save package database cache")
+
+    def __query(self, query, *args):
+        stamp = self.packageDb.getDatabaseStamp()
+        if stamp is None: return getattr(self.packageDb, query)(*args)
+        if not self.__loaded: self.__load(stamp)
+        if stamp != self.__stamp:
+            self.__answers = {}
+            self.__stamp = stamp
+        key = (query,) + args
+        if not self.__answers.has_key(key):
+            self.__answers[key] = getattr(self.packageDb, query)(*args)
+            self.__changed = True
+        answer = self.__answers[key]
+        if isinstance(answer, list): answer = list(answer)
+        return answer
+
+    def getVersion(self, packageName):
+        return self.__query('getVersion', packageName)
+
+    def getFiles(self, packageName):
+        return self.__query('getFiles', packageName)
+
+    def getFilesOfPackages(self, packageNames):
+        return self.__query('getFilesOfPackages', tuple(packageNames))
+
+    def getMoFiles(self, locale = None):
+        return self.__query('getMoFiles', locale)
+
+    def getDependencies(self, packageName):
+        return self.__query('getDependencies', packageName)
+
 class Distro:
     """
     Class representing a distribution.
@@ -315,5 +489,5 @@ def detectDistro():
     return distro
 
 distro = detectDistro()
-packageDb = distro.packageDb
+packageDb = CachedPackageDb(distro.packageDb)
 
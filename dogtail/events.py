@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for listening to AT-SPI events from within a script.
+
+Scripts don't normally run a main loop, so the events the registry sends us
+are only dispatched while the default GLib main context is being iterated.
+EventQueue takes care of that: it registers itself as a listener for some
+event types and pumps the main context whenever it is asked for the events
+it has collected.
+"""
+
+import time
+import pyatspi
+
+def pump():
+    """
+    Dispatch any events that are waiting in the default main context.
+    """
+    import gobject
+    context = gobject.main_context_default()
+    while context.pending():
+        context.iteration(False)
+
+class EventQueue:
+    """
+    Collects AT-SPI events of the given types until they are retrieved.
+
+    eventTypes is a sequence of event names as accepted by
+    pyatspi.Registry.registerEventListener, e.g. 'object:children-changed'.
+    If eventFilter is given, only events for which it returns True are kept.
+
+    The queue starts listening as soon as it is created; call close() when
+    it is no longer needed.
+    """
+    pollInterval = 0.01
+
+    def __init__(self, eventTypes, eventFilter = None):
+        self.eventTypes = tuple(eventTypes)
+        self.eventFilter = eventFilter
+        self.events = []
+        pyatspi.Registry.registerEventListener(self._onEvent, *self.eventTypes)
+
+    def _onEvent(self, event):
+        if self.eventFilter is None or self.eventFilter(event):
+            self.events.append(event)
+
+    def get(self, timeout = 0):
+        """
+        Return the events collected since the last call, waiting up to
+        timeout seconds for at least one to arrive.
+        """
+        deadline = time.time() + timeout
+        while True:
+            pump()
+            if self.events or time.time() >= deadline: break
+            time.sleep(self.pollInterval)
+        events = self.events
+        self.events = []
+        return events
+
+    def close(self):
+        """
+        Stop listening for events.
+        """
+        pyatspi.Registry.deregisterEventListener(self._onEvent,
+                *self.eventTypes)
+
+class IdleMonitor:
+    """
+    Waits for an application to settle down after being acted on, by
+    listening for the AT-SPI events it sends. The listeners are registered
+    only while waitForQuiet is waiting, so the rest of the time no events are
+    sent to the script on the monitor's account.
+
+    AT-SPI events don't say when they happened, so each one is timestamped
+    when pump() delivers it; waitForQuiet pumps every EventQueue.pollInterval
+    seconds, which bounds the error. Events from other applications are
+    dropped by looking up the application of their source, which is only
+    asked for the first time a source is seen.
+    """
+    eventTypes = ('object', 'window', 'focus')
+    maxSources = 1000
+
+    def __init__(self):
+        self.lastEventTime = 0
+        self.application = None
+        self.sourceApplications = {}
+
+    def _onEvent(self, event):
+        if self.application is not None:
+            try:
+                source = event.source
+                application = self.sourceApplications.get(source)
+                if application is None:
+                    if len(self.sourceApplications) >= self.maxSources:
+                        self.sourceApplications.clear()
+                    application = source.getApplication()
+                    self.sourceApplications[source] = application
+                if application != self.application: return
+            except Exception: return
+        self.lastEventTime = time.time()
+
+    def waitForQuiet(self, timeout, quietPeriod, application = None):
+        """
+        Wait until the given application (or if it is None, every application)
+        has sent no events for quietPeriod seconds, counting from the start of
+        the wait at the earliest, or until timeout seconds have passed.
+        Returns the time waited.
+        """
+        start = time.time()
+        deadline = start + timeout
+        self.application = application
+        self.lastEventTime = 0
+        pyatspi.Registry.registerEventListener(self._onEvent, *self.eventTypes)
+        try:
+            while True:
+                pump()
+                now = time.time()
+                quietAt = max(self.lastEventTime, start) + quietPeriod
+                if now >= quietAt or now >= deadline: break
+                time.sleep(min(EventQueue.pollInterval, deadline - now))
+        finally:
+            pyatspi.Registry.deregisterEventListener(self._onEvent,
+                    *self.eventTypes)
+            self.application = None
+        return time.time() - start
+
+    def close(self):
+        """
+        Forget the applications of the event sources seen so far.
+        """
+        global idleMonitor
+        self.sourceApplications.clear()
+        if idleMonitor is self: idleMonitor = None
+
+idleMonitor = None
+
+def getIdleMonitor():
+    """
+    Get the IdleMonitor, creating it if needed.
+    """
+    global idleMonitor
+    if idleMonitor is None: idleMonitor = IdleMonitor()
+    return idleMonitor
@@ -12,6 +12,11 @@ import config
 import os
 import re
 import gettext
+import mmap
+import struct
+import unittest
+try: from hashlib import md5
+except ImportError: from md5 import md5
 
 from logging import debugLogger as logger
 
@@ -60,6 +65,48 @@ class GettextTranslationDb(TranslationDb):
     def __init__(self, moFile):
         self.__moFile = moFile
         self.__gnutranslations = gettext.GNUTranslations(open(moFile))
+        self.__acceleratorIndex = None
+
+    def __buildAcceleratorIndex(self):
+        """
+        Map every string that is a msgid of the catalog with one underscore
+        taken out (except a trailing one) to the translations of those
+        msgids, with underscores stripped out. This answers the lookups
+        getTranslationsOf used to make by inserting an underscore at every
+        position of the string.
+        """
+        index = {}
+        for msgid, msgstr in self.__gnutranslations._catalog.items():
+            # Skip plural forms, which are keyed by (msgid, n):
+            if not isinstance(msgid, basestring) or not msgid: continue
+            msgid = safeDecode(msgid)
+            msgstr = safeDecode(msgstr)
+            if msgstr == msgid: continue
+            position = msgid.find('_')
+            while position != -1 and position < len(msgid) - 1:
+                stripped = msgid[:position] + msgid[position + 1:]
+                index.setdefault(stripped, {})[msgstr.replace('_','')] = True
+                position = msgid.find('_', position + 1)
+        self.__acceleratorIndex = index
+
+    def getAllTranslations(self):
+        """
+        Get a dictionary mapping every string this catalog has translations
+        for to the list of those translations, as getTranslationsOf would
+        return it.
+        """
+        if self.__acceleratorIndex is None: self.__buildAcceleratorIndex()
+        results = {}
+        for srcName, translations in self.__acceleratorIndex.items():
+            results[srcName] = dict(translations)
+        for msgid, msgstr in self.__gnutranslations._catalog.items():
+            if not isinstance(msgid, basestring) or not msgid: continue
+            msgid = safeDecode(msgid)
+            msgstr = safeDecode(msgstr)
+            if msgstr != msgid: results.setdefault(msgid, {})[msgstr] = None
+        for srcName in results.keys():
+            results[srcName] = results[srcName].keys()
+        return results
 
     def getTranslationsOf(self, srcName):
         srcName = safeDecode(srcName)
@@ -79,24 +126,200 @@ class GettextTranslationDb(TranslationDb):
         #
         # Since these underscores have been stripped out before we see these strings,
         # we are looking for a translation of "Add" into "Ajouter" in this case, so
-        # we need to fake it, by looking up the string multiple times, with underscores
-        # inserted in all possible positions, stripping underscores out of the result.
-        # Ugly, but it works.
+        # we need to fake it, by looking up the string as if it had an underscore
+        # in any position, stripping underscores out of the result. Rather than
+        # doing so one position at a time, the catalog is indexed once by msgid
+        # with the underscore taken out.
 
-        for index in range(len(srcName)):
-            candidate = srcName[:index]+"_"+srcName[index:]
-            result = self.__gnutranslations.ugettext(candidate)
-            if result!=candidate:
-                # Strip out the underscore, and add to the result:
-                results[result.replace('_','')]=True
+        if self.__acceleratorIndex is None: self.__buildAcceleratorIndex()
+        results.update(self.__acceleratorIndex.get(srcName, {}))
 
         return results.keys()
 
+class IndexedTranslationDb(TranslationDb):
+    """
+    Implementation of TranslationDb which looks up the translations of a whole
+    set of mo-files in an index file under config.scratchDir, so that the
+    mo-files only need to be parsed by the first process that uses them.
+
+    The index starts with a header listing the mo-files along with their
+    modification times and sizes; if any of them has changed (or the file is
+    missing), the index is rebuilt. The header is followed by the number of
+    entries, a table of offsets and the entries themselves, sorted by source
+    string, each being the UTF-8 source string and its translations separated
+    by NUL bytes. The file is memory-mapped and searched with a binary search,
+    so loading it takes the same time however many translations it holds.
+    """
+    magic = 'dogtail translation index 1\n'
+
+    def __init__(self, moFiles):
+        self.moFiles = list(moFiles)
+        digest = md5('\n'.join(self.moFiles)).hexdigest()
+        self.indexFile = os.path.join(config.config.scratchDir,
+                'translations-%s.idx' % digest)
+        header = self.__makeHeader()
+        if not self.__load(header):
+            self.__build(header)
+            if not self.__load(header):
+                raise IOError, "Could not load translation index " + \
+                        self.indexFile
+
+    def __makeHeader(self):
+        header = self.magic
+        for moFile in self.moFiles:
+            try:
+                stat = os.stat(moFile)
+                header += "%d %d %s\n" % (stat.st_mtime, stat.st_size, moFile)
+            except OSError:
+                header += "-1 -1 %s\n" % moFile
+        return header + "\n"
+
+    def __load(self, header):
+        try: indexFile = open(self.indexFile, 'rb')
+        except IOError: return False
+        try:
+            if indexFile.read(len(header)) != header: return False
+            self.__map = mmap.mmap(indexFile.fileno(), 0,
+                    access = mmap.ACCESS_READ)
+        finally:
+            indexFile.close()
+        self.__count = struct.unpack('<I',
+                self.__map[len(header):len(header) + 4])[0]
+        self.__table = len(header) + 4
+        if config.config.debugTranslation:
+            logger.log("Loaded %d translations from %s" % \
+                    (self.__count, self.indexFile))
+        return True
+
+    def __build(self, header):
+        translations = {}
+        for moFile in self.moFiles:
+            try: moTranslations = GettextTranslationDb(moFile).getAllTranslations()
+            except (IOError, AttributeError, IndexError):
+                if config.config.debugTranslation:
+                    logger.log("Warning: Failed to load mo-file for translation: " + moFile)
+                continue
+            for srcName, results in moTranslations.items():
+                merged = translations.setdefault(srcName.encode('utf-8'), {})
+                for result in results: merged[result.encode('utf-8')] = True
+        srcNames = translations.keys()
+        srcNames.sort()
+        records = []
+        for srcName in srcNames:
+            records.append('\0'.join([srcName] + translations[srcName].keys()))
+        # Offsets of the start of each record, plus the end of the last one:
+        offsets = []
+        offset = len(header) + 4 + 4 * (len(records) + 1)
+        for record in records:
+            offsets.append(offset)
+            offset += len(record)
+        offsets.append(offset)
+        # Write to a private file and rename it, since other processes may be
+        # reading or building the same index:
+        tempFile = "%s.%d" % (self.indexFile, os.getpid())
+        indexFile = open(tempFile, 'wb')
+        try:
+            indexFile.write(header)
+            indexFile.write(struct.pack('<I', len(records)))
+            indexFile.write(struct.pack('<%dI' % len(offsets), *offsets))
+            indexFile.write(''.join(records))
+        finally:
+            indexFile.close()
+        os.rename(tempFile, self.indexFile)
+        if config.config.debugTranslation:
+            logger.log("Wrote %d translations to %s" % \
+                    (len(records), self.indexFile))
+
+    def __record(self, i):
+        position = self.__table + 4 * i
+        start, end = struct.unpack('<II', self.__map[position:position + 8])
+        return self.__map[start:end].split('\0')
+
+    def getTranslationsOf(self, srcName):
+        srcName = safeDecode(srcName).encode('utf-8')
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            record = self.__record(middle)
+            if record[0] < srcName: low = middle + 1
+            elif record[0] > srcName: high = middle
+            else: return [safeDecode(result) for result in record[1:]]
+        return []
+
+class LRUCache:
+    """
+    A mapping holding at most maxSize items, which forgets the least recently
+    used item to make room for a new one.
+
+    The items are kept in a circular doubly-linked list of [previous, next,
+    key, value] lists, most recently used first, so that every operation
+    takes constant time.
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.clear()
+
+    def clear(self):
+        self.__links = {}
+        self.__head = [None, None, None, None]
+        self.__head[0] = self.__head[1] = self.__head
+
+    def __len__(self):
+        return len(self.__links)
+
+    def __unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def __linkFirst(self, link):
+        link[0] = self.__head
+        link[1] = self.__head[1]
+        self.__head[1][0] = link
+        self.__head[1] = link
+
+    def get(self, key, default = None):
+        link = self.__links.get(key)
+        if link is None: return default
+        self.__unlink(link)
+        self.__linkFirst(link)
+        return link[3]
+
+    def __setitem__(self, key, value):
+        link = self.__links.get(key)
+        if link is not None:
+            self.__unlink(link)
+            link[3] = value
+        else:
+            if len(self.__links) >= self.maxSize:
+                oldest = self.__head[0]
+                self.__unlink(oldest)
+                del self.__links[oldest[2]]
+            link = [None, None, key, value]
+            self.__links[key] = link
+        self.__linkFirst(link)
+
+    def __delitem__(self, key):
+        self.__unlink(self.__links.pop(key))
+
+# The results of translate(), for the translationDbs they were looked up in.
+translationCache = LRUCache(1024)
+translationCacheDbs = []
+
 def translate(srcString):
     """
     Look up srcString in the various translation databases (if any), returning
     a list of all matches found (potentially the empty list)
+
+    Results are cached until translationDbs is changed.
     """
+    global translationCacheDbs
+    if translationCacheDbs != translationDbs:
+        translationCache.clear()
+        translationCacheDbs = list(translationDbs)
+    srcString = safeDecode(srcString)
+    results = translationCache.get(srcString)
+    if results is not None: return list(results)
+
     # Use a dict to get uniqueness:
     results = {}
     # Try to translate the string:
@@ -109,8 +332,36 @@ def translate(srcString):
     if len(results)==0:
         if config.config.debugTranslation:
             logger.log('Translation not found for "%s"'%srcString)
+    translationCache[srcString] = results.keys()
     return results.keys()
 
+# Characters that make TranslatableString.matchedBy() do more than compare
+# strings for equality. Parentheses aren't here since they are escaped.
+regexSpecialChars = '.^$*+?{}[]\\|'
+
+def compileMatcher(string):
+    """
+    Turn one of the strings a TranslatableString matches against into a
+    (literal, regex) pair, where literal is the string as unicode and regex is
+    the compiled regular expression to try when the literal isn't equal to
+    the string being tested, or None if the string contains no regular
+    expression syntax (or isn't a valid regular expression).
+    """
+    literal = safeDecode(string)
+    isPattern = False
+    for char in literal:
+        if char in regexSpecialChars:
+            isPattern = True
+            break
+    if not isPattern: return (literal, None)
+    pattern = literal + '$'
+    if pattern[0] == '*':
+        pattern = "\\" + pattern
+    # Escape all parentheses, since grouping will never be needed here
+    pattern = re.sub('([\(\)])', r'\\\1', pattern)
+    try: return (literal, re.compile(pattern))
+    except re.error: return (literal, None)
+
 class TranslatableString:
     """
     Class representing a string that we want to match strings against, handling
@@ -120,7 +371,8 @@ class TranslatableString:
     def __init__(self, untranslatedString):
         """
         Constructor looks up the string in all of the translation databases, storing
-        the various translations it finds.
+        the various translations it finds, and compiles the matchers used by
+        matchedBy().
         """
         if isinstance(untranslatedString, unicode):
             untranslatedString = safeDecode(untranslatedString)
@@ -128,48 +380,55 @@ class TranslatableString:
             untranslatedString = safeDecode(untranslatedString)
         self.untranslatedString = untranslatedString
         self.translatedStrings = translate(untranslatedString)
+        self.matchers = []
+        for string in self.translatedStrings + [self.untranslatedString]:
+            self.matchers.append(compileMatcher(string))
+
+    def literalStrings(self):
+        """
+        If none of the strings this instance matches against contain regular
+        expression syntax, return them (as unicode), since a string is then
+        matched exactly when it is equal to one of them. Otherwise return
+        None.
+        """
+        result = []
+        for literal, regex in self.matchers:
+            if regex is not None: return None
+            for char in literal:
+                if char in regexSpecialChars: return None
+            if literal not in result: result.append(literal)
+        return result
 
     def matchedBy(self, string):
         """
         Compare the test string against either the translation of the original
         string (or simply the original string, if no translation was found).
+
+        Each of those is treated as a regular expression if it contains any
+        regular expression syntax (apart from parentheses); otherwise the
+        strings are simply compared.
         """
-        #print "comparing %s against %s"%(string, self)
-        def stringsMatch(inS, outS):
-            """
-            Compares a regular expression to a string
-
-            inS: the regular expression (or normal string)
-            outS: the normal string to be compared against
-            """
-            inString = str(inS)
-            outString = outS
-            if inString == outString:
+        if string is None: return False
+        string = safeDecode(string)
+        for literal, regex in self.matchers:
+            if literal == string: return True
+            if regex is not None and regex.match(string) is not None:
                 return True
-            inString = inString + '$'
-            inString = safeDecode(inString)
-            outString = safeDecode(outString)
-            if inString[0] == '*':
-                inString = "\\" + inString
-            # Escape all parentheses, since grouping will never be needed here
-            inString = re.sub('([\(\)])', r'\\\1', inString)
-            match = re.match(inString, outString)
-            matched = match is not None
-            return matched
-
-        matched = False
-        # the 'ts' variable keeps track of whether we're working with
-        # translated strings. it's only used for debugging purposes.
-        #ts = 0
-        #print string, str(self)
-        for translatedString in self.translatedStrings:
-            #ts = ts + 1
-            matched = stringsMatch(translatedString, string)
-            if not matched:
-                matched = translatedString == string
-            if matched: return matched
-        #ts=0
-        return stringsMatch(self.untranslatedString, string)
+        return False
+
+    def __eq__(self, other):
+        """
+        Instances are equal if they were made from the same untranslated
+        string (and so match the same strings).
+        """
+        return isinstance(other, TranslatableString) and \
+                self.untranslatedString == other.untranslatedString
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.untranslatedString)
 
     def __str__(self):
         """
@@ -207,8 +466,11 @@ def isMoFile(filename, language = ''):
 
 def loadAllTranslationsForLanguage(language):
     import distro
-    result = []
-    for moFile in distro.packageDb.getMoFiles(language):
+    moFiles = distro.packageDb.getMoFiles(language)
+    if config.config.cacheTranslations:
+        translationDbs.append(IndexedTranslationDb(moFiles))
+        return
+    for moFile in moFiles:
         translationDbs.append(GettextTranslationDb(moFile))
 
 def getMoFilesForPackage(packageName, language = '', getDependencies=True):
@@ -220,17 +482,17 @@ def getMoFilesForPackage(packageName, language = '', getDependencies=True):
     import distro
 
     result = []
-    for filename in distro.packageDb.getFiles(packageName):
+    filenames = distro.packageDb.getFiles(packageName)
+    if getDependencies:
+        # Get the files of all of the dependencies in one query:
+        dependencies = distro.packageDb.getDependencies(packageName)
+        filenames = filenames + \
+                distro.packageDb.getFilesOfPackages(dependencies)
+
+    for filename in filenames:
         if isMoFile(filename, language):
             result.append(filename)
 
-    if getDependencies:
-        # Recurse:
-        for dep in distro.packageDb.getDependencies(packageName):
-            # We pass False to the inner call because getDependencies has already
-            # walked the full tree
-            result.extend(getMoFilesForPackage(dep, language, False))
-
     return result
 
 def loadTranslationsFromPackageMoFiles(packageName, getDependencies=True):
@@ -240,12 +502,18 @@ def loadTranslationsFromPackageMoFiles(packageName, getDependencies=True):
     """
     # Keep a list of mo-files that are already in use to avoid duplicates.
     moFiles = {}
+    # With config.cacheTranslations, they are all loaded from one index:
+    indexedMoFiles = []
     def load(packageName, language = '', getDependencies = True):
         for moFile in getMoFilesForPackage(packageName, language, getDependencies):
             # Searching the popt mo-files for translations makes gettext bail out,
             # so we ignore them here. This is
             # https://bugzilla.redhat.com/bugzilla/show_bug.cgi?id=172155 .
             if 'popt.mo' not in moFile and not (moFiles.has_key(moFile)):
+                if config.config.cacheTranslations:
+                    indexedMoFiles.append(moFile)
+                    moFiles[moFile] = None
+                    continue
                 try:
                     translationDbs.append(GettextTranslationDb(moFile))
                     moFiles[moFile] = None
@@ -267,3 +535,85 @@ def loadTranslationsFromPackageMoFiles(packageName, getDependencies=True):
     if isinstance(distro.distro, distro.Ubuntu):
         load('language-pack-gnome-%s' % language, language)
     load(packageName, language, getDependencies)
+    if indexedMoFiles:
+        translationDbs.append(IndexedTranslationDb(indexedMoFiles))
+
+class I18nTests(unittest.TestCase):
+    def testLRUCache(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEquals(cache.get('a'), 1)
+        # 'b' is now the least recently used:
+        cache['c'] = 3
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+        self.assertEquals(len(cache), 2)
+        del cache['a']
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(len(cache), 1)
+        cache['d'] = 4
+        self.assertEquals(cache.get('c'), 3)
+
+    def testTranslateCache(self):
+        class CountingDb(TranslationDb):
+            lookups = 0
+            def getTranslationsOf(self, srcName):
+                CountingDb.lookups += 1
+                return [u'Ajouter']
+        db = CountingDb()
+        translationDbs.append(db)
+        try:
+            self.assertEquals(translate('Add'), [u'Ajouter'])
+            self.assertEquals(translate('Add'), [u'Ajouter'])
+            self.assertEquals(CountingDb.lookups, 1)
+        finally:
+            translationDbs.remove(db)
+        self.assertEquals(translate('Add'), [])
+
+    def writeMoFile(self, fileName, catalog):
+        msgids = catalog.keys()
+        msgids.sort()
+        ids = strs = ''
+        idTable = []
+        strTable = []
+        start = 28 + 16 * len(msgids)
+        for msgid in msgids:
+            idTable.extend([len(msgid), start + len(ids)])
+            ids += msgid + '\0'
+        start += len(ids)
+        for msgid in msgids:
+            strTable.extend([len(catalog[msgid]), start + len(strs)])
+            strs += catalog[msgid] + '\0'
+        moFile = open(fileName, 'wb')
+        moFile.write(struct.pack('<7I', 0x950412deL, 0, len(msgids), 28,
+                28 + 8 * len(msgids), 0, 0))
+        moFile.write(struct.pack('<%dI' % len(idTable), *idTable))
+        moFile.write(struct.pack('<%dI' % len(strTable), *strTable))
+        moFile.write(ids + strs)
+        moFile.close()
+
+    def testIndexedTranslationDb(self):
+        moFile = os.path.join(config.config.scratchDir, 'i18ntest.mo')
+        self.writeMoFile(moFile, {
+            '' : 'Content-Type: text/plain; charset=UTF-8\n',
+            '_Add' : 'A_jouter', 'Open' : 'Ouvrir', 'Save _As' : 'Enregistrer _sous'})
+        gettextDb = GettextTranslationDb(moFile)
+        self.assertEquals(gettextDb.getTranslationsOf('Add'), [u'Ajouter'])
+        self.assertEquals(gettextDb.getTranslationsOf('Save As'),
+                [u'Enregistrer sous'])
+        indexedDb = IndexedTranslationDb([moFile])
+        try:
+            for srcName in ('Add', '_Add', 'Open', 'Save As', 'Close'):
+                self.assertEquals(indexedDb.getTranslationsOf(srcName),
+                        gettextDb.getTranslationsOf(srcName))
+            # A second instance loads the index built by the first:
+            self.assertEquals(IndexedTranslationDb([moFile]).getTranslationsOf(
+                'Open'), [u'Ouvrir'])
+        finally:
+            os.remove(moFile)
+            os.remove(indexedDb.indexFile)
+
+if __name__ == "__main__":
+    unittest.main()
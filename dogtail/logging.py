@@ -11,8 +11,12 @@ David Malcolm <dmalcolm@redhat.com>
 """
 import os
 import sys
+import glob
 import time
 import datetime
+import atexit
+import threading
+import Queue
 from config import config
 import codecs
 
@@ -138,33 +142,96 @@ class Logger:
         function, but nice and simple for now.
 
         If force is True, log to a file irrespective of config.logDebugToFile.
+
+        With config.asyncLogging set, the message is handed to the LogWriter
+        thread instead of being written here.
         """
-        message = message.decode('utf-8', 'replace')
+        toFile = force or config.logDebugToFile
+        toStdOut = self.stdOut and config.logDebugToStdOut
 
         # Try to open and write the result to the log file.
-        if isinstance(self.file, bool) and (force or config.logDebugToFile):
+        if isinstance(self.file, bool) and toFile:
             self.createFile()
 
-        if force or config.logDebugToFile:
+        if config.asyncLogging:
+            getLogWriter().write(self, message, newline, toFile, toStdOut)
+        else:
+            self.write(message, newline, toFile, toStdOut)
+            if toFile: self.file.flush()
+
+    def write(self, message, newline, toFile, toStdOut):
+        """
+        Write the message to the log file and/or standard out, without
+        flushing the file.
+        """
+        message = message.decode('utf-8', 'replace')
+
+        if toFile:
             if newline: self.file.write(message + '\n')
             else: self.file.write(message + ' ')
-            self.file.flush()
 
-        if self.stdOut and config.logDebugToStdOut: 
+        if toStdOut:
             if newline: print message
             else: print message,
 
+def importJson():
+    """
+    Get the json module, or simplejson on Pythons older than 2.6.
+    """
+    try: import json
+    except ImportError: import simplejson as json
+    return json
+
+def getOutcome(result):
+    """
+    Get the outcome of a test case result such as "Passed", or "Failed - see
+    diff.png", as 'passed', 'failed' or 'error'.
+    """
+    outcome = result.split(' ', 1)[0].lower()
+    if outcome in ('passed', 'failed'): return outcome
+    return 'error'
+
 class ResultsLogger(Logger):
     """
     Writes entries into the Dogtail log
     """
     def __init__(self, stdOut = True):
         Logger.__init__(self, 'results', file = True, stdOut = stdOut)
+        self.structuredFile = None
+        self.lastResultTime = time.time()
+
+    def logStructured(self, label, result, details = None):
+        """
+        Write the result as a line of JSON to the file next to the results
+        log. Each line holds an object with the time, script name, process id,
+        label, result, outcome ('passed', 'failed' or 'error') and
+        stepDuration (the time since the previous result, or since this logger
+        was created), plus any details given, such as the test case type,
+        the duration of the comparison and the node's search path.
+        """
+        json = importJson()
+        if self.structuredFile is None:
+            self.structuredFile = codecs.open(self.fileName + '.jsonl',
+                    mode = 'ab', encoding = 'utf-8')
+        now = time.time()
+        if not isinstance(label, unicode): label = str(label).decode('utf-8', 'replace')
+        if not isinstance(result, unicode): result = str(result).decode('utf-8', 'replace')
+        record = {'time': now, 'script': config.scriptName,
+                'pid': os.getpid(), 'label': label, 'result': result,
+                'outcome': getOutcome(result),
+                'stepDuration': now - self.lastResultTime}
+        self.lastResultTime = now
+        if details: record.update(details)
+        self.structuredFile.write(json.dumps(record) + '\n')
+        self.structuredFile.flush()
 
     # Writes the result of a test case comparison to the log
-    def log(self, entry):
+    def log(self, entry, details = None):
         """
         Writes the log entry. Requires a 1 {key: value} pair dict for an argument or else it will throw an exception.
+
+        With config.structuredResults set, the entry is also written to the
+        structured results log, along with the details dict, if given.
         """
         # We require a 1 key: value dict
         # Strip all leading and trailing witespace from entry dict and convert
@@ -181,6 +248,141 @@ class ResultsLogger(Logger):
             print "Method argument requires a 1 {key: value} dict. Supplied argument not one {key: value}"
 
         Logger.log(self, self.stamper.entryStamp() + "      " + entry, force = True)
+        if config.structuredResults: self.logStructured(key, value, details)
+
+def aggregateResults(fileNames = None):
+    """
+    Combine the structured results logs written by any number of runs (by
+    default, all of those in config.logDir) into a dictionary mapping each
+    test case label to a summary of its results: the test case type, the
+    number of runs, the number of each outcome, the pass rate, and the
+    mean, median, 90th percentile and maximum durations of the comparisons
+    and steps.
+    """
+    json = importJson()
+    if fileNames is None:
+        fileNames = glob.glob(os.path.join(config.logDir, '*.jsonl'))
+    records = {}
+    for fileName in fileNames:
+        structuredFile = open(fileName)
+        try:
+            for line in structuredFile:
+                line = line.strip()
+                if not line: continue
+                try: record = json.loads(line)
+                except ValueError: continue
+                records.setdefault(record.get('label'), []).append(record)
+        finally:
+            structuredFile.close()
+
+    def summarize(values):
+        if not values: return None
+        values.sort()
+        return {'mean': sum(values) / len(values),
+                'median': values[len(values) // 2],
+                'p90': values[min(len(values) - 1, int(len(values) * 0.9))],
+                'max': values[-1]}
+
+    summary = {}
+    for label, labelRecords in records.items():
+        outcomes = {'passed': 0, 'failed': 0, 'error': 0}
+        durations = []
+        stepDurations = []
+        for record in labelRecords:
+            outcome = record.get('outcome', 'error')
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if record.has_key('duration'): durations.append(record['duration'])
+            if record.has_key('stepDuration'):
+                stepDurations.append(record['stepDuration'])
+        summary[label] = {'type': labelRecords[-1].get('type'),
+                'runs': len(labelRecords),
+                'outcomes': outcomes,
+                'passRate': float(outcomes['passed']) / len(labelRecords),
+                'duration': summarize(durations),
+                'stepDuration': summarize(stepDurations)}
+    return summary
+
+class LogWriter(threading.Thread):
+    """
+    Background thread which writes the entries logged while
+    config.asyncLogging is set, in the order they were logged. Entries are
+    taken off the queue in batches, and the files written to are flushed once
+    per batch. The queue is bounded, so a script logging faster than the
+    entries can be written is slowed down rather than using up memory.
+    """
+    maxQueued = 1000
+    batchSize = 100
+
+    def __init__(self):
+        threading.Thread.__init__(self, name = 'LogWriter')
+        self.setDaemon(True)
+        self.queue = Queue.Queue(self.maxQueued)
+        self.start()
+
+    def write(self, logger, message, newline, toFile, toStdOut):
+        """
+        Queue the message to be written by logger.write().
+        """
+        self.queue.put((logger, (message, newline, toFile, toStdOut)))
+
+    def flush(self, timeout = 10):
+        """
+        Wait (up to timeout seconds) until everything queued so far has been
+        written and flushed.
+        """
+        if not self.isAlive(): return
+        done = threading.Event()
+        self.queue.put((None, done))
+        done.wait(timeout)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batchSize:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty: pass
+            files = []
+            for logger, args in batch:
+                if logger is None:
+                    self.__flush(files)
+                    args.set()
+                    continue
+                try:
+                    logger.write(*args)
+                    if args[2] and logger.file not in files:
+                        files.append(logger.file)
+                except Exception:
+                    # There's nowhere left to report this.
+                    pass
+            self.__flush(files)
+
+    def __flush(self, files):
+        for file in files:
+            try: file.flush()
+            except Exception: pass
+        del files[:]
+        try: sys.stdout.flush()
+        except Exception: pass
+
+logWriter = None
+
+def getLogWriter():
+    """
+    Get the LogWriter thread, starting it if needed.
+    """
+    global logWriter
+    if logWriter is None:
+        logWriter = LogWriter()
+        atexit.register(logWriter.flush)
+    return logWriter
+
+def flushLogs():
+    """
+    Wait until everything logged so far has been written, if config.asyncLogging
+    is in use.
+    """
+    if logWriter is not None: logWriter.flush()
 
 debugLogger = Logger('debug', config.logDebugToFile)
 
@@ -189,6 +391,11 @@ def exceptionHook(exc, value, tb):
     tbStringList = traceback.format_exception(exc, value, tb)
     tbString = ''.join(tbStringList)
     debugLogger.log(tbString)
+    import capture
+    try: capture.dumpFrames()
+    except Exception, e:
+        debugLogger.log("Warning: Failed to write captured frames: %s" % e)
+    flushLogs()
     sys.exc_clear()
 
 sys.excepthook = exceptionHook
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and latency histograms for finding out where a script spends its
+time.
+
+Nothing is recorded unless config.collectMetrics is set. The operations
+instrumented include:
+
+    tree.search           Node.findChild, also per predicate class, e.g.
+                          tree.search.IsAButtonNamed
+    tree.search.retries   failed findChild attempts that were retried
+    tree.action           Action.do, also per action name, e.g.
+                          tree.action.click
+    ipc.calls             AT-SPI calls made while walking the tree
+    rawinput.key          keys pressed, including those typed by typeText
+    utils.delay           delays, whether sleeping or adaptive
+    utils.run             utils.run, including waiting for the application
+    capture.frame         grabbing a frame of the screen, see dogtail.capture
+
+The collected metrics are written to the debug log when the script exits;
+call dump() to write them at any other point.
+"""
+
+import time
+import atexit
+import unittest
+from config import config
+from logging import debugLogger as logger
+
+class Histogram:
+    """
+    Counts durations (in seconds) in buckets whose upper bounds double from
+    one millisecond up to about a minute, with one more bucket for anything
+    longer, and keeps their total, minimum and maximum.
+    """
+    bounds = [0.001 * 2 ** i for i in range(17)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, duration):
+        bucket = 0
+        while bucket < len(self.bounds) and duration > self.bounds[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min: self.min = duration
+        if self.max is None or duration > self.max: self.max = duration
+
+    def percentile(self, fraction):
+        """
+        Get an upper bound on the given percentile (as a fraction) of the
+        durations, i.e. the upper bound of the bucket it falls in, or the
+        maximum if that is lower.
+        """
+        if not self.count: return None
+        wanted = fraction * self.count
+        seen = 0
+        for bucket in range(len(self.counts)):
+            seen += self.counts[bucket]
+            if seen >= wanted and seen:
+                if bucket < len(self.bounds):
+                    return min(self.bounds[bucket], self.max)
+                return self.max
+        return self.max
+
+# Counters and histograms, by name.
+counters = {}
+histograms = {}
+
+haveRegisteredDump = False
+
+def registerDump():
+    global haveRegisteredDump
+    if not haveRegisteredDump:
+        atexit.register(dump)
+        haveRegisteredDump = True
+
+def count(name, amount = 1):
+    """
+    Add the amount to the named counter.
+    """
+    if not config.collectMetrics: return
+    registerDump()
+    counters[name] = counters.get(name, 0) + amount
+
+def record(name, duration):
+    """
+    Add the duration (in seconds) to the named histogram.
+    """
+    if not config.collectMetrics: return
+    registerDump()
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = Histogram()
+        histograms[name] = histogram
+    histogram.add(duration)
+
+def timed(name, detail = None):
+    """
+    Decorator recording the duration of each call of the function in the
+    named histogram. If detail is given, it is called with the function's
+    arguments, and if it returns something, the duration is also recorded
+    under the name followed by a dot and that.
+    """
+    def decorate(function):
+        def wrapper(*args, **kwargs):
+            if not config.collectMetrics: return function(*args, **kwargs)
+            start = time.time()
+            try: return function(*args, **kwargs)
+            finally:
+                duration = time.time() - start
+                record(name, duration)
+                if detail is not None:
+                    try: suffix = detail(*args, **kwargs)
+                    except Exception: suffix = None
+                    if suffix: record("%s.%s" % (name, suffix), duration)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        wrapper.__dict__.update(function.__dict__)
+        return wrapper
+    return decorate
+
+def reset():
+    """
+    Forget everything recorded so far.
+    """
+    counters.clear()
+    histograms.clear()
+
+def report():
+    """
+    Get the metrics as a table, with the histograms ordered by the total time
+    spent in them, longest first.
+    """
+    lines = []
+    if histograms:
+        lines.append("%-40s %8s %10s %9s %9s %9s %9s" % ('operation',
+            'count', 'total (s)', 'mean (ms)', 'p50 (ms)', 'p90 (ms)',
+            'max (ms)'))
+        names = histograms.keys()
+        names.sort(key = lambda name: -histograms[name].total)
+        for name in names:
+            histogram = histograms[name]
+            lines.append("%-40s %8d %10.3f %9.1f %9.1f %9.1f %9.1f" % (name,
+                histogram.count, histogram.total,
+                1000 * histogram.total / histogram.count,
+                1000 * histogram.percentile(0.5),
+                1000 * histogram.percentile(0.9), 1000 * histogram.max))
+    if counters:
+        lines.append("%-40s %8s" % ('counter', 'value'))
+        names = counters.keys()
+        names.sort()
+        for name in names:
+            lines.append("%-40s %8d" % (name, counters[name]))
+    return '\n'.join(lines)
+
+def dump(file = None):
+    """
+    Write the report to the given file object, or to the debug log.
+    """
+    if not counters and not histograms: return
+    if file is None: logger.log("Metrics:\n" + report())
+    else: file.write(report() + '\n')
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.collectMetrics = config.collectMetrics
+        config.collectMetrics = True
+        reset()
+
+    def tearDown(self):
+        config.collectMetrics = self.collectMetrics
+        reset()
+
+    def testHistogram(self):
+        histogram = Histogram()
+        for duration in (0.0005, 0.003, 0.003, 0.5):
+            histogram.add(duration)
+        self.assertEquals(histogram.count, 4)
+        self.assertEquals(histogram.max, 0.5)
+        self.assertEquals(histogram.percentile(0.5), 0.004)
+        self.assertEquals(histogram.percentile(1.0), 0.5)
+
+    def testTimed(self):
+        def search(name): return name
+        search = timed('search', lambda name: name)(search)
+        self.assertEquals(search('button'), 'button')
+        self.assertEquals(histograms['search'].count, 1)
+        self.assertEquals(histograms['search.button'].count, 1)
+
+    def testDisabled(self):
+        config.collectMetrics = False
+        count('calls')
+        record('search', 0.1)
+        self.assertEquals(counters, {})
+        self.assertEquals(histograms, {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,16 @@ Author: David Malcolm <dmalcolm@redhat.com>
 """
 __author__ = """David Malcolm <dmalcolm@redhat.com>"""
 
+from config import config
+from logging import debugLogger as logger
+from i18n import LRUCache
+
+# The nodes found by SearchPath.resolve, keyed by the tuple of components of
+# the path (or prefix of a path) that led to each, as (root, node) pairs.
+# Only the most recently used ones are kept, so that a long run doesn't keep
+# every node it ever resolved alive.
+resolvedNodes = LRUCache(256)
+
 class SearchPath:
     """
     Class used by the recording framework (and for more verbose script
@@ -25,12 +35,17 @@ class SearchPath:
 
     def __init__(self):
         self.__list = []
+        self.__string = None
 
     def __str__(self):
-        result = "{"
-        for (predicate, isRecursive) in self.__list:
-            result += "/(%s,%s)"%(predicate.describeSearchResult(), isRecursive)
-        return result+"}"
+        # Paths are logged far more often than they change, so the string is
+        # only built once per change:
+        if self.__string is None:
+            result = "{"
+            for (predicate, isRecursive) in self.__list:
+                result += "/(%s,%s)"%(predicate.describeSearchResult(), isRecursive)
+            self.__string = result+"}"
+        return self.__string
 
     # We need equality to work so that dicts of these work:
     def __eq__(self, other):
@@ -49,6 +64,17 @@ class SearchPath:
     def append(self, predicate, isRecursive):
         assert predicate
         self.__list.append((predicate, isRecursive))
+        self.__string = None
+
+    def copy(self):
+        """
+        Get a new instance with the same components, which can be appended to
+        without affecting this one.
+        """
+        result = SearchPath()
+        result.__list = list(self.__list)
+        result.__string = self.__string
+        return result
 
     def __iter__(self):
         return iter(self.__list)
@@ -105,6 +131,44 @@ class SearchPath:
             result.__list.append(self.__list[i])
         return result
 
+    def resolve(self, root):
+        """
+        Find the node this path leads to, starting at root (normally
+        dogtail.tree.root) and applying each search in turn with findChild,
+        which raises SearchError if one of them fails.
+
+        The node found for every prefix of the path is cached (up to a limit,
+        dropping the least recently used ones first), so resolving a
+        path that shares a prefix with one resolved earlier (see getPrefix)
+        starts from the deepest cached node that still exists and still
+        satisfies its predicate, rather than from root.
+        """
+        components = tuple(self.__list)
+        node = root
+        start = 0
+        for i in range(len(components), 0, -1):
+            key = components[:i]
+            cached = resolvedNodes.get(key)
+            if cached is None: continue
+            cachedRoot, cachedNode = cached
+            try:
+                valid = cachedRoot == root and \
+                        key[-1][0].satisfiedByNode(cachedNode)
+            except Exception: valid = False
+            if valid:
+                node = cachedNode
+                start = i
+                break
+            del resolvedNodes[key]
+        if config.debugSearchPaths:
+            logger.log("resolving %s from step %s of %s" % \
+                    (self, start, len(components)))
+        for i in range(start, len(components)):
+            (predicate, isRecursive) = components[i]
+            node = node.findChild(predicate, recursive = isRecursive)
+            resolvedNodes[components[:i + 1]] = (root, node)
+        return node
+
     def getPredicate(self, i):
         (predicate, isRecursive) = self.__list[i]
         return predicate
@@ -42,10 +42,40 @@ def makeCamel(string):
             result += lowercaseWord.capitalize()
     return result
 
+def makeIndexKeys(roleNames, name):
+    """
+    Build the list of (roleName, name) pairs returned by
+    Predicate.indexKeys() for a node with any of the given roleNames, and a
+    name matched by the given TranslatableString (or any name, if name is
+    None). Returns None if the name can't be looked up literally.
+    """
+    if name is None: return [(roleName, None) for roleName in roleNames]
+    names = name.literalStrings()
+    if names is None: return None
+    result = []
+    for roleName in roleNames:
+        for string in names:
+            result.append((roleName, string))
+    return result
+
 class Predicate:
     """Abstract base class representing a predicate function on nodes.
 
-    It's more than just a function in that it has data and can describe itself"""
+    It's more than just a function in that it has data and can describe itself
+
+    Subclasses build satisfiedByNode once, at construction, with their
+    TranslatableStrings' matchers already compiled, and list the node
+    attributes it reads in 'fields', in the order it reads them. A search
+    only needs to fetch those attributes of each node, and can stop at the
+    first one that rules the node out. A value of None means any attribute
+    may be read.
+
+    A predicate whose showingOnly attribute is True only looks for nodes
+    that are on screen: searches for it skip any node that isn't both
+    SHOWING and VISIBLE, along with everything below it.
+    """
+    fields = None
+    showingOnly = False
     def satisfiedByNode(self, node):
         """Pure virtual method returning a boolean if the predicate is satisfied by the node"""
         raise NotImplementedError
@@ -53,6 +83,16 @@ class Predicate:
     def describeSearchResult(self, node):
         raise NotImplementedError
 
+    def indexKeys(self):
+        """
+        Return a list of (roleName, name) pairs such that any node satisfying
+        this predicate has the roleName and name of one of them, so that it can
+        be found through a tree.SearchIndex. A name of None stands for any
+        name. Returns None if the predicate can't be answered that way, which
+        is the default.
+        """
+        return None
+
     def makeScriptMethodCall(self, isRecursive):
         """
         Method to generate a string containing a (hopefully) readable search
@@ -70,20 +110,39 @@ class Predicate:
         """
         raise NotImplementedError
 
+    def __data(self):
+        """
+        The data the predicate was built from, i.e. its attributes apart from
+        the functions built from them (satisfiedByNode), which differ between
+        any two instances.
+        """
+        data = [(name, value) for (name, value) in self.__dict__.items() \
+                if not callable(value)]
+        data.sort(key = lambda item: item[0])
+        return data
+
     def __eq__(self, other):
         """
         Predicates are considered equal if they are of the same subclass and
         have the same data
         """
-        # print "predeq: self:%s"%self
-        # print "               other:%s"%other
-        # print "predeq: selfdict:%s"%self.__dict__
-        # print "               otherdict:%s"%other.__dict__
-
-        if type(self)!=type(other):
+        if not isinstance(other, Predicate) or \
+                self.__class__ != other.__class__:
             return False
         else:
-            return self.__dict__ == other.__dict__
+            return self.__data() == other.__data()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        # Equal predicates must hash equally, so that SearchPaths made of them
+        # can be used as dictionary keys.
+        result = hash(self.__class__)
+        for item in self.__data():
+            try: result ^= hash(item)
+            except TypeError: result ^= hash(item[0])
+        return result
 
 
 class IsAnApplicationNamed(Predicate):
@@ -93,9 +152,12 @@ class IsAnApplicationNamed(Predicate):
         self.debugName = self.describeSearchResult()
         self.satisfiedByNode = self._genCompareFunc()
 
+    fields = ('roleName', 'name')
+
     def _genCompareFunc(self):
+        matchedBy = self.appName.matchedBy
         def satisfiedByNode(node):
-            return node.roleName=='application' and stringMatches(self.appName, node.name)
+            return node.roleName=='application' and matchedBy(node.name)
         return satisfiedByNode
 
     def describeSearchResult(self):
@@ -111,13 +173,14 @@ class IsAnApplicationNamed(Predicate):
 class GenericPredicate(Predicate):
     """SubtreePredicate subclass that takes various optional search fields"""
 
-    def __init__(self, name = None, roleName = None, description= None, label = None, debugName=None):
+    def __init__(self, name = None, roleName = None, description= None, label = None, debugName=None, showingOnly=False):
         if name:
             self.name = TranslatableString(name)
         else:
             self.name = None
         self.roleName = roleName
         self.description = description
+        self.showingOnly = showingOnly
         if label:
             self.label = TranslatableString(label)
         else:
@@ -138,30 +201,51 @@ class GenericPredicate(Predicate):
                 self.debugName += " description='%s'"%description
         assert self.debugName
 
+        if self.label:
+            self.fields = ('labeller',)
+        else:
+            fields = []
+            if self.roleName: fields.append('roleName')
+            if self.name: fields.append('name')
+            if self.description: fields.append('description')
+            self.fields = tuple(fields)
         self.satisfiedByNode = self._genCompareFunc()
 
 
     def _genCompareFunc(self):
-        def satisfiedByNode(node):
-            # labelled nodes are handled specially:
-            if self.label:
+        # labelled nodes are handled specially:
+        if self.label:
+            labelMatchedBy = self.label.matchedBy
+            def satisfiedByNode(node):
                 # this reverses the search; we're looking for a node with LABELLED_BY
                 # and then checking the label, rather than looking for a label and
                 # then returning whatever LABEL_FOR targets
-                if node.labeller:
-                    return stringMatches(self.label, node.labeller.name)
+                labeller = node.labeller
+                if labeller:
+                    return labelMatchedBy(labeller.name)
                 else: return False
-            else:
-                # Ensure the node matches any criteria that were set:
-                if self.name:
-                    if not stringMatches(self.name,node.name): return False
-                if self.roleName:
-                    if self.roleName!=node.roleName: return False
-                if self.description:
-                    if self.description!=node.description: return False
-                return True
+            return satisfiedByNode
+
+        # Ensure the node matches any criteria that were set, checking the
+        # cheap string comparisons before the name:
+        roleName = self.roleName
+        description = self.description
+        if self.name: nameMatchedBy = self.name.matchedBy
+        else: nameMatchedBy = None
+        def satisfiedByNode(node):
+            if roleName:
+                if roleName!=node.roleName: return False
+            if nameMatchedBy:
+                if not nameMatchedBy(node.name): return False
+            if description:
+                if description!=node.description: return False
+            return True
         return satisfiedByNode
 
+    def indexKeys(self):
+        if self.label or self.description or not self.roleName: return None
+        return makeIndexKeys((self.roleName,), self.name)
+
     def describeSearchResult(self):
         return self.debugName
 
@@ -197,9 +281,12 @@ class IsNamed(Predicate):
         self.debugName = self.describeSearchResult()
         self.satisfiedByNode = self._genCompareFunc()
 
+    fields = ('name',)
+
     def _genCompareFunc(self):
+        matchedBy = self.name.matchedBy
         def satisfiedByNode(node):
-            return stringMatches(self.name, node.name)
+            return matchedBy(node.name)
         return satisfiedByNode
 
     def describeSearchResult(self):
@@ -217,11 +304,17 @@ class IsAWindowNamed(Predicate):
         self.debugName = self.describeSearchResult()
         self.satisfiedByNode = self._genCompareFunc()
 
+    fields = ('roleName', 'name')
+
     def _genCompareFunc(self):
+        matchedBy = self.windowName.matchedBy
         def satisfiedByNode(node):
-            return node.roleName=='frame' and stringMatches(self.windowName, node.name)
+            return node.roleName=='frame' and matchedBy(node.name)
         return satisfiedByNode
 
+    def indexKeys(self):
+        return makeIndexKeys(('frame',), self.windowName)
+
     def describeSearchResult(self):
         return "%s window"%self.windowName
 
@@ -233,9 +326,14 @@ class IsAWindowNamed(Predicate):
 
 class IsAWindow(Predicate):
     """Predicate subclass that looks for top-level windows"""
+    fields = ('roleName',)
+
     def __init__(self):
         self.satisfiedByNode = lambda node: node.roleName == 'frame'
 
+    def indexKeys(self):
+        return makeIndexKeys(('frame',), None)
+
     def describeSearchResult(self):
         return "window"
 
@@ -246,11 +344,17 @@ class IsADialogNamed(Predicate):
         self.debugName = self.describeSearchResult()
         self.satisfiedByNode = self._genCompareFunc()
 
+    fields = ('roleName', 'name')
+
     def _genCompareFunc(self):
+        matchedBy = self.dialogName.matchedBy
         def satisfiedByNode(node):
-            return node.roleName=='dialog' and stringMatches(self.dialogName, node.name)
+            return node.roleName=='dialog' and matchedBy(node.name)
         return satisfiedByNode
 
+    def indexKeys(self):
+        return makeIndexKeys(('dialog',), self.dialogName)
+
     def describeSearchResult(self):
         return '%s dialog'%self.dialogName
 
@@ -271,11 +375,15 @@ class IsLabelledAs(Predicate):
         self.debugName = self.describeSearchResult()
         self.satisfiedByNode = self._genCompareFunc()
 
+    fields = ('labeller',)
+
     def _genCompareFunc(self):
+        matchedBy = self.labelText.matchedBy
         def satisfiedByNode(node):
             # FIXME
-            if node.labeller:
-                return stringMatches(self.labelText, node.labeller.name)
+            labeller = node.labeller
+            if labeller:
+                return matchedBy(labeller.name)
             else: return False
         return satisfiedByNode
 
@@ -290,11 +398,17 @@ class IsLabelledAs(Predicate):
 
 class IsAMenuNamed(Predicate):
     """Predicate subclass that looks for a menu by name"""
+    fields = ('roleName', 'name')
+
     def __init__(self, menuName):
         self.menuName = TranslatableString(menuName)
         self.debugName = self.describeSearchResult()
+        matchedBy = self.menuName.matchedBy
         self.satisfiedByNode = lambda node: node.roleName=='menu' and \
-                stringMatches(self.menuName, node.name)
+                matchedBy(node.name)
+
+    def indexKeys(self):
+        return makeIndexKeys(('menu',), self.menuName)
 
     def describeSearchResult(self):
         return '%s menu'%(self.menuName)
@@ -307,12 +421,21 @@ class IsAMenuNamed(Predicate):
 
 class IsAMenuItemNamed(Predicate):
     """Predicate subclass that looks for a menu item by name"""
+    fields = ('roleName', 'name')
+
     def __init__(self, menuItemName):
         self.menuItemName = TranslatableString(menuItemName)
         self.debugName = self.describeSearchResult()
+        matchedBy = self.menuItemName.matchedBy
         self.satisfiedByNode = lambda node: \
-                node.roleName.endswith('menu item') and \
-                stringMatches(self.menuItemName, node.name)
+                node.roleName.endswith('menu item') and matchedBy(node.name)
+
+    # All of the AT-SPI role names that end with 'menu item':
+    menuItemRoleNames = ('menu item', 'check menu item', 'radio menu item',
+            'tear off menu item')
+
+    def indexKeys(self):
+        return makeIndexKeys(self.menuItemRoleNames, self.menuItemName)
 
     def describeSearchResult(self):
         return '%s menuitem'%(self.menuItemName)
@@ -325,11 +448,17 @@ class IsAMenuItemNamed(Predicate):
 
 class IsATextEntryNamed(Predicate):
     """Predicate subclass that looks for a text entry by name"""
+    fields = ('roleName', 'name')
+
     def __init__(self, textEntryName):
         self.textEntryName = TranslatableString(textEntryName)
         self.debugName = self.describeSearchResult()
+        matchedBy = self.textEntryName.matchedBy
         self.satisfiedByNode = lambda node: node.roleName == 'text' and \
-                stringMatches(self.textEntryName, node.name)
+                matchedBy(node.name)
+
+    def indexKeys(self):
+        return makeIndexKeys(('text',), self.textEntryName)
 
     def describeSearchResult(self):
         return '%s textentry'%(self.textEntryName)
@@ -342,11 +471,17 @@ class IsATextEntryNamed(Predicate):
 
 class IsAButtonNamed(Predicate):
     """Predicate subclass that looks for a button by name"""
+    fields = ('roleName', 'name')
+
     def __init__(self, buttonName):
         self.buttonName = TranslatableString(buttonName)
         self.debugName = self.describeSearchResult()
+        matchedBy = self.buttonName.matchedBy
         self.satisfiedByNode = lambda node: node.roleName == 'push button' \
-                and stringMatches(self.buttonName, node.name)
+                and matchedBy(node.name)
+
+    def indexKeys(self):
+        return makeIndexKeys(('push button',), self.buttonName)
 
     def describeSearchResult(self):
         return '%s button'%(self.buttonName)
@@ -359,11 +494,17 @@ class IsAButtonNamed(Predicate):
 
 class IsATabNamed(Predicate):
     """Predicate subclass that looks for a tab by name"""
+    fields = ('roleName', 'name')
+
     def __init__(self, tabName):
         self.tabName = TranslatableString(tabName)
         self.debugName = self.describeSearchResult()
+        matchedBy = self.tabName.matchedBy
         self.satisfiedByNode = lambda node: node.roleName=='page tab' and \
-                stringMatches(self.tabName, node.name)
+                matchedBy(node.name)
+
+    def indexKeys(self):
+        return makeIndexKeys(('page tab',), self.tabName)
 
     def describeSearchResult(self):
         return '%s tab'%(self.tabName)
@@ -422,5 +563,49 @@ class PredicateTests(unittest.TestCase):
         dummyTab = DummyNode('dummy', 'page tab')
         self.assertTrue(IsATabNamed(dummyTab.name).satisfiedByNode(dummyTab))
 
+    def testEquality(self):
+        self.assertEquals(IsAButtonNamed('OK'), IsAButtonNamed('OK'))
+        self.assertNotEquals(IsAButtonNamed('OK'), IsAButtonNamed('Cancel'))
+        self.assertNotEquals(IsAButtonNamed('OK'), IsNamed('OK'))
+        self.assertEquals(GenericPredicate(name='OK', roleName='push button'),
+                GenericPredicate(name='OK', roleName='push button'))
+        self.assertEquals(hash(IsAMenuNamed('File')),
+                hash(IsAMenuNamed('File')))
+
+    def testFields(self):
+        self.assertEquals(IsAButtonNamed('OK').fields, ('roleName', 'name'))
+        self.assertEquals(GenericPredicate(name='OK', roleName='label').fields,
+                ('roleName', 'name'))
+        self.assertEquals(GenericPredicate(label='Name').fields, ('labeller',))
+
+    def testRegularExpressionNames(self):
+        class DummyNode:
+            def __init__(self, name = '', roleName = ''):
+                self.name = name
+                self.roleName = roleName
+        self.assertTrue(IsNamed('Save As.*').satisfiedByNode(DummyNode('Save As...')))
+        self.assertTrue(IsNamed('Open (recent)').satisfiedByNode(DummyNode('Open (recent)')))
+        self.assertTrue(IsNamed('*').satisfiedByNode(DummyNode('*')))
+        self.assertFalse(IsNamed('Open').satisfiedByNode(DummyNode('Open...')))
+        self.assertFalse(IsNamed('[broken').satisfiedByNode(DummyNode('x')))
+        self.assertTrue(IsNamed('[broken').satisfiedByNode(DummyNode('[broken')))
+
+    def testIndexKeys(self):
+        self.assertEquals(IsAButtonNamed('OK').indexKeys(),
+                [('push button', u'OK')])
+        self.assertEquals(GenericPredicate(roleName='table cell').indexKeys(),
+                [('table cell', None)])
+        self.assertEquals(len(IsAMenuItemNamed('Quit').indexKeys()), 4)
+        # Regular expressions and names alone can't be looked up:
+        self.assertEquals(IsAButtonNamed('Save As...').indexKeys(), None)
+        self.assertEquals(GenericPredicate(name='OK').indexKeys(), None)
+        self.assertEquals(IsNamed('OK').indexKeys(), None)
+
+    def testShowingOnly(self):
+        self.failIf(IsAButtonNamed('OK').showingOnly)
+        self.failIf(GenericPredicate(roleName='table cell').showingOnly)
+        self.assert_(GenericPredicate(roleName='table cell',
+                showingOnly=True).showingOnly)
+
 if __name__ == "__main__":
     unittest.main()
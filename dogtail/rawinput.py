@@ -4,6 +4,9 @@ Handles raw input using AT-SPI event generation.
 
 Note: Think of keyvals as keysyms, and keynames as keystrings.
 
+The GTK+ bindings are only imported by the functions that need them, since
+importing them takes a noticeable part of a short script's run time.
+
 Authors: David Malcolm <dmalcolm@redhat.com>, Zack Cerza <zcerza@redhat.com>
 """
 
@@ -12,10 +15,11 @@ David Malcolm <dmalcolm@redhat.com>,
 Zack Cerza <zcerza@redhat.com>
 """
 
-import gtk.keysyms
-import gtk.gdk
 from config import config
 from utils import doDelay
+from utils import gdkLocked
+import events
+import metrics
 from logging import debugLogger as logger
 from pyatspi import Registry as registry
 from pyatspi import (KEY_SYM, KEY_PRESS, KEY_PRESSRELEASE, KEY_RELEASE)
@@ -23,6 +27,7 @@ from pyatspi import (KEY_SYM, KEY_PRESS, KEY_PRESSRELEASE, KEY_RELEASE)
 def doTypingDelay():
     doDelay(config.typingDelay)
 
+@metrics.timed('rawinput.click')
 def click (x, y, button = 1):
     """
     Synthesize a mouse button click at (x,y)
@@ -91,14 +96,31 @@ def drag(fromXY, toXY, button = 1):
     release (x, y, button)
     doDelay()
 
-def typeText(string):
+@metrics.timed('rawinput.typeText')
+def typeText(string, bulk = None):
     """
     Types the specified string, one character at a time.
+
+    If bulk is True (or is None, and config.bulkTyping is set), all of the
+    characters are resolved to keysyms before any is typed, and the key
+    events are sent in batches of config.typingBatchSize, delaying only after
+    each batch.
     """
     if not isinstance(string, unicode):
         string = string.decode('utf-8')
-    for char in string:
-        pressKey(char)
+    if bulk is None: bulk = config.bulkTyping
+    if not bulk:
+        for char in string:
+            pressKey(char)
+        return
+
+    keySyms = [keyNameToKeySym(char) for char in string]
+    batchSize = max(1, config.typingBatchSize)
+    for start in range(0, len(keySyms), batchSize):
+        for keySym in keySyms[start:start + batchSize]:
+            registry.generateKeyboardEvent(keySym, None, KEY_SYM)
+        metrics.count('rawinput.key', len(keySyms[start:start + batchSize]))
+        doTypingDelay()
 
 keyNameAliases = {
     'enter' : 'Return',
@@ -117,12 +139,14 @@ keyNameAliases = {
 }
 
 def keySymToUniChar(keySym):
+    import gtk.gdk
     i = gtk.gdk.keyval_to_unicode(keySym)
     if i: UniChar = unichr(i)
     else: UniChar = ''
     return UniChar
 
 def uniCharToKeySym(uniChar):
+    import gtk.gdk
     # OK, if it's not actually unicode we can fix that, right?
     if not isinstance(uniChar, unicode): uniChar = unicode(uniChar)
     i = ord(uniChar)
@@ -130,21 +154,90 @@ def uniCharToKeySym(uniChar):
     return keySym
 
 def keySymToKeyName(keySym):
+    import gtk.gdk
     return gtk.gdk.keyval_name(keySym)
 
+# The keysyms found by keyNameToKeySym, by key name. Keysyms don't depend on
+# the keyboard layout, so they never need to be looked up again.
+keySyms = {}
+
 def keyNameToKeySym(keyName):
+    keySym = keySyms.get(keyName)
+    if keySym is not None: return keySym
+    import gtk.gdk
+    import gtk.keysyms
     try:
-        keyName = keyNameAliases.get(keyName.lower(), keyName)
-        keySym = gtk.gdk.keyval_from_name(keyName)
-        if not keySym: keySym = getattr(gtk.keysyms, keyName)
+        name = keyNameAliases.get(keyName.lower(), keyName)
+        keySym = gtk.gdk.keyval_from_name(name)
+        if not keySym: keySym = getattr(gtk.keysyms, name)
     except AttributeError:
-        try: keySym = uniCharToKeySym(keyName)
+        try: keySym = uniCharToKeySym(name)
         except TypeError: raise KeyError, keyName
+    keySyms[keyName] = keySym
     return keySym
 
-def keyNameToKeyCode(keyName):
+class KeyCodeCache:
+    """
+    The keycodes found by keyNameToKeyCode on one display. Unlike keysyms,
+    keycodes depend on the keyboard layout, so the cache is emptied whenever
+    GDK reports that the display's keymap has changed. That signal is only
+    delivered while the main context is iterated, which getKeyCodeCache
+    does.
+    """
+    @gdkLocked
+    def __init__(self, display):
+        import gtk.gdk
+        self.keymap = gtk.gdk.keymap_get_for_display(display)
+        self.keyCodes = {}
+        self.keymap.connect('keys-changed', self.__keysChanged)
+
+    def __keysChanged(self, keymap):
+        self.keyCodes.clear()
+
+    @gdkLocked
+    def get(self, keyName):
+        if self.keyCodes.has_key(keyName): return self.keyCodes[keyName]
+        import gtk.gdk
+        entries = self.keymap.get_entries_for_keyval( \
+                gtk.gdk.keyval_from_name(keyName))
+        try: keyCode = entries[0][0]
+        except TypeError: keyCode = None
+        self.keyCodes[keyName] = keyCode
+        return keyCode
+
+# The KeyCodeCache of each display, by display name, and that of the default
+# display, which is the only one most scripts use.
+keyCodeCaches = {}
+defaultKeyCodeCache = None
+
+def getKeyCodeCache(display = None):
+    """
+    Get the KeyCodeCache of the given gtk.gdk.Display, or of the default
+    display, creating it if needed.
+    """
+    events.pump()
+    return findKeyCodeCache(display)
+
+@gdkLocked
+def findKeyCodeCache(display):
+    global defaultKeyCodeCache
+    if display is None:
+        if defaultKeyCodeCache is None:
+            import gtk.gdk
+            defaultKeyCodeCache = findKeyCodeCache(
+                    gtk.gdk.display_get_default())
+        return defaultKeyCodeCache
+    cache = keyCodeCaches.get(display.get_name())
+    if cache is None:
+        cache = KeyCodeCache(display)
+        keyCodeCaches[display.get_name()] = cache
+    return cache
+
+def keyNameToKeyCode(keyName, display = None):
     """
-    Use GDK to get the keycode for a given keystring.
+    Use GDK to get the keycode for a given keystring, on the given
+    gtk.gdk.Display or the default one. Keycodes are cached until the keymap
+    changes.
 
     Note that the keycode returned by this function is often incorrect when
     the requested keystring is obtained by holding down the Shift key.
@@ -152,11 +245,7 @@ def keyNameToKeyCode(keyName):
     Generally you should use uniCharToKeySym() and should only need this
     function for nonprintable keys anyway.
     """
-    keymap = gtk.gdk.keymap_get_default()
-    entries = keymap.get_entries_for_keyval( \
-            gtk.gdk.keyval_from_name(keyName))
-    try: return entries[0][0]
-    except TypeError: pass
+    return getKeyCodeCache(display).get(keyName)
 
 def pressKey(keyName):
     """
@@ -167,16 +256,22 @@ def pressKey(keyName):
     """
     keySym = keyNameToKeySym(keyName)
     registry.generateKeyboardEvent(keySym, None, KEY_SYM)
+    metrics.count('rawinput.key')
     doTypingDelay()
 
-def keyCombo(comboString):
-    """
-    Generates the appropriate keyboard events to simulate a user pressing the
-    specified key combination.
+# The results of parseKeyCombo, by combo string.
+keyCombos = {}
 
-    comboString is the representation of the key combo to be generated.
-    e.g. '<Control><Alt>p' or '<Control><Shift>PageUp' or '<Control>q'
+def parseKeyCombo(comboString):
     """
+    Split a key combination such as '<Control><Shift>PageUp' into the list of
+    names of the modifier keys and the name of the final key, raising
+    ValueError if any of them isn't the name of a key. The results are
+    memoized.
+    """
+    combo = keyCombos.get(comboString)
+    if combo is not None: return combo
+    import gtk.keysyms
     strings = []
     for s in comboString.split('<'):
         if s:
@@ -188,18 +283,29 @@ def keyCombo(comboString):
         if not hasattr(gtk.keysyms, s):
             raise ValueError, "Cannot find key %s" % s
 
-    modifiers = strings[:-1]
-    finalKey = strings[-1]
-    
-    for modifier in modifiers:
-        code = keyNameToKeyCode(modifier)
+    combo = (strings[:-1], strings[-1])
+    keyCombos[comboString] = combo
+    return combo
+
+@metrics.timed('rawinput.keyCombo')
+def keyCombo(comboString):
+    """
+    Generates the appropriate keyboard events to simulate a user pressing the
+    specified key combination.
+
+    comboString is the representation of the key combo to be generated.
+    e.g. '<Control><Alt>p' or '<Control><Shift>PageUp' or '<Control>q'
+    """
+    modifiers, finalKey = parseKeyCombo(comboString)
+    modifierCodes = [keyNameToKeyCode(modifier) for modifier in modifiers]
+
+    for code in modifierCodes:
         registry.generateKeyboardEvent(code, None, KEY_PRESS)
 
     code = keyNameToKeySym(finalKey)
     registry.generateKeyboardEvent(code, None, KEY_SYM)
     
-    for modifier in modifiers:
-        code = keyNameToKeyCode(modifier)
+    for code in modifierCodes:
         registry.generateKeyboardEvent(code, None, KEY_RELEASE)
 
     doTypingDelay()
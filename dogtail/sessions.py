@@ -1,5 +1,6 @@
 import time
 import os
+import sys
 import errno
 import re
 import subprocess
@@ -7,6 +8,8 @@ import signal
 import tempfile
 import random
 import glob
+import threading
+import Queue
 from dogtail.config import config
 
 def scratchFile(label):
@@ -81,6 +84,13 @@ class XServer(Subprocess):
         usedDisplays.sort()
         return ':' + str(usedDisplays[-1] + 1)
 
+    @staticmethod
+    def isDisplayInUse(number):
+        """Is there a lock file or a socket for the given display number,
+        i.e. is (or was) an X server running on it?"""
+        return os.path.exists('/tmp/.X%d-lock' % number) or \
+                os.path.exists('/tmp/.X11-unix/X%d' % number)
+
     @property
     def cmdList(self):
         if self.display is None:
@@ -111,8 +121,13 @@ class Session(object):
 
     cookieName = "DOGTAIL_SESSION_COOKIE"
 
+    # Exits successfully once the AT-SPI desktop of the session on $DISPLAY
+    # answers and has at least one application on it.
+    readyProbe = [sys.executable, '-c', 'import sys, pyatspi; ' +
+            'sys.exit(pyatspi.Registry.getDesktop(0).childCount == 0)']
+
     def __init__(self, sessionBinary, server, script, display=None,
-                 quiet=False, scriptDelay=10, logout=True):
+                 quiet=False, scriptDelay=10, logout=True, readyTimeout=60):
 
         testBinary(sessionBinary)
         self.sessionBinary = sessionBinary
@@ -131,26 +146,77 @@ class Session(object):
 
         self.script = script
         self.scriptDelay = scriptDelay
+        self.readyTimeout = readyTimeout
         self.logout = logout
         self._cookie = None
         self._environment = None
 
     def start(self):
-        # Start an X server if requested
-        if self.xserver is None:
-            xServerPid = None
-        else:
-            self.xinitrcFileObj = scratchFile('xinitrc')
-            self.xserver.xinitrc = self.xinitrcFileObj.name
-            self._buildXInitRC(self.xinitrcFileObj)
-            xServerPid = self.xserver.start()
-            time.sleep(self.scriptDelay)
-
+        xServerPid = self.startServer()
         self.script.environ = self.environment
         scriptPid = self.script.start()
 
         return (xServerPid, scriptPid)
 
+    def startServer(self):
+        """Starts the X server and the session in it, if one is to be started,
+        and waits until the session is ready for scripts. Returns the X
+        server's pid, or None."""
+        if self.xserver is None: return None
+        self.xinitrcFileObj = scratchFile('xinitrc')
+        self.xserver.xinitrc = self.xinitrcFileObj.name
+        self._buildXInitRC(self.xinitrcFileObj)
+        xServerPid = self.xserver.start()
+        self.waitUntilReady()
+        return xServerPid
+
+    def waitUntilReady(self, interval=0.5):
+        """Waits scriptDelay seconds, then until the session's AT-SPI desktop
+        answers (see isReady), for up to readyTimeout seconds in all. If it
+        doesn't answer by then, the session is used anyway, as long as its
+        environment can be found."""
+        deadline = time.time() + max(self.scriptDelay, self.readyTimeout)
+        time.sleep(self.scriptDelay)
+        while True:
+            if not self.alive:
+                raise RuntimeError("The X server exited before the " +
+                        "session started")
+            if self.isReady(deadline): return
+            if time.time() >= deadline:
+                # Raises RuntimeError if the session never got going at all
+                self.environment
+                print >> sys.stderr, "Warning: the session's desktop " + \
+                        "didn't answer within %s seconds" % self.readyTimeout
+                return
+            time.sleep(interval)
+
+    def isReady(self, deadline=None, probeTimeout=10):
+        """Whether the session's environment can be found and its AT-SPI
+        desktop answers, as checked by running readyProbe in it. The probe
+        is given up on after probeTimeout seconds, or at deadline."""
+        try: environment = self.environment
+        except RuntimeError: return False
+        probeDeadline = time.time() + probeTimeout
+        if deadline is not None: probeDeadline = min(probeDeadline, deadline)
+        devnull = open(os.devnull, 'w')
+        try:
+            probe = subprocess.Popen(self.readyProbe, env=environment,
+                                     stdout=devnull, stderr=devnull)
+            while probe.poll() is None:
+                if time.time() >= probeDeadline:
+                    try: os.kill(probe.pid, signal.SIGKILL)
+                    except OSError: pass
+                    probe.wait()
+                    return False
+                time.sleep(0.1)
+        finally: devnull.close()
+        return probe.returncode == 0
+
+    @property
+    def alive(self):
+        """Whether the X server we started is still running."""
+        return self.xserver is not None and self.xserver.popen.poll() is None
+
     @property
     def environment(self):
         def isSessionProcess(fileName):
@@ -219,8 +285,9 @@ class Session(object):
             return self.xserver.wait()
 
     def stop(self):
-        try: self.script.stop()
-        except OSError: pass
+        if self.script is not None:
+            try: self.script.stop()
+            except OSError: pass
         if self.xserver is not None:
             self.xserver.stop()
 
@@ -233,7 +300,7 @@ class Session(object):
     @property
     def cookie(self):
         if not self._cookie:
-            self._cookie = "%X" % random.getrandbits(16)
+            self._cookie = "%X" % random.getrandbits(32)
         return self._cookie
 
     def _buildXInitRC(self, fileObj):
@@ -252,3 +319,200 @@ class Session(object):
 
         fileObj.write('\n'.join(lines).strip())
         fileObj.flush()
+
+
+class OutputCopier(threading.Thread):
+    """Copies the lines read from a pipe to a file, each one prefixed with
+    the given string, so that the output of scripts running at the same time
+    can be told apart."""
+
+    lock = threading.Lock()
+
+    def __init__(self, pipe, file, prefix):
+        threading.Thread.__init__(self, name='OutputCopier')
+        self.setDaemon(True)
+        self.pipe = pipe
+        self.file = file
+        self.prefix = prefix
+        self.start()
+
+    def run(self):
+        for line in iter(self.pipe.readline, ''):
+            self.lock.acquire()
+            try:
+                self.file.write(self.prefix + line)
+                self.file.flush()
+            finally: self.lock.release()
+        self.pipe.close()
+
+class SessionWorker(threading.Thread):
+    """Runs the scripts handed out by a SessionPool, one at a time, in a
+    session of its own on the given display. The session is kept for the
+    next script if that is safe (see canRecycle), and replaced otherwise."""
+
+    scriptCookieName = "DOGTAIL_SCRIPT_COOKIE"
+
+    def __init__(self, pool, display):
+        threading.Thread.__init__(self, name='SessionWorker%s' % display)
+        self.setDaemon(True)
+        self.pool = pool
+        self.display = display
+        self.session = None
+        self.scriptsRun = 0
+
+    def run(self):
+        while True:
+            item = self.pool.queue.get()
+            if item is None: break
+            index, script = item
+            try:
+                self.pool.exitCodes[index] = self.runScript(index, script)
+            except Exception, e:
+                self.pool.errors[index] = e
+                self.retire()
+        self.retire()
+
+    def runScript(self, index, script):
+        if self.session is None:
+            pool = self.pool
+            self.session = Session(pool.sessionBinary, pool.server, None,
+                                   self.display, pool.quiet, pool.scriptDelay,
+                                   pool.logout, pool.readyTimeout)
+            self.scriptsRun = 0
+            self.session.startServer()
+        self.session.script = script
+        # Tag the script's environment, so that the applications it leaves
+        # behind can be found afterwards.
+        scriptCookie = "%d.%d" % (os.getpid(), index)
+        script.environ = dict(self.session.environment)
+        script.environ[self.scriptCookieName] = scriptCookie
+
+        copiers = []
+        prefix = "[%d] " % (index + 1)
+        if self.pool.prefixOutput:
+            if script.stdout is None: script.stdout = subprocess.PIPE
+            if script.stderr is None: script.stderr = subprocess.PIPE
+        script.start()
+        if script.stdout is subprocess.PIPE:
+            copiers.append(OutputCopier(script.popen.stdout, sys.stdout, prefix))
+        if script.stderr is subprocess.PIPE:
+            copiers.append(OutputCopier(script.popen.stderr, sys.stderr, prefix))
+        exitCode = script.exitCode
+        self.scriptsRun += 1
+        # Leftovers may hold the pipes open, so they have to go first
+        leftoversKilled = self.killLeftovers(scriptCookie)
+        for copier in copiers: copier.join()
+        if not (leftoversKilled and self.canRecycle(exitCode)): self.retire()
+        return exitCode
+
+    def findLeftovers(self, scriptCookie):
+        """Returns the pids of the processes whose environment has the given
+        script cookie."""
+        entry = "%s=%s" % (self.scriptCookieName, scriptCookie)
+        pids = []
+        for path in glob.glob('/proc/[0-9]*/environ'):
+            try: environ = open(path).read()
+            except IOError: continue
+            if entry in environ.split('\x00'):
+                pids.append(int(path.split('/')[2]))
+        return pids
+
+    def killLeftovers(self, scriptCookie, timeout=5):
+        """Terminates the processes the script left running, killing those
+        that don't go within timeout seconds. Returns whether they all went."""
+        signals = (signal.SIGTERM, signal.SIGKILL)
+        for sig in signals:
+            pids = self.findLeftovers(scriptCookie)
+            if not pids: return True
+            for pid in pids:
+                try: os.kill(pid, sig)
+                except OSError: pass
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                if not self.findLeftovers(scriptCookie): return True
+                time.sleep(0.1)
+        return False
+
+    def canRecycle(self, exitCode):
+        """A session is only reused after a script that succeeded, while its
+        X server is still running and its desktop still answers, and for at
+        most the pool's maxScripts scripts."""
+        if not self.pool.recycle or exitCode != 0: return False
+        maxScripts = self.pool.maxScripts
+        if maxScripts is not None and self.scriptsRun >= maxScripts:
+            return False
+        return self.session.alive and self.session.isReady()
+
+    def retire(self):
+        session = self.session
+        if session is None: return
+        self.session = None
+        if session.logout and session.alive:
+            try: session.attemptLogout()
+            except (OSError, IOError, RuntimeError): pass
+        try: session.stop()
+        except OSError: pass
+        session.xserver.wait()
+
+class SessionPool(object):
+    """Runs scripts in up to size X server sessions at once, each on a
+    display of its own, so that a list of scripts isn't limited to running
+    one session after another. Each session needs an X server of its own, so
+    server should be a virtual one such as Xvfb.
+
+    Unless recycle is False, a session is reused for the next script after a
+    script exits successfully, once the applications it left running have
+    been terminated, up to maxScripts scripts per session (any number if it
+    is None); otherwise it is replaced by a fresh one.
+
+    With prefixOutput set, the output of scripts with no stdout or stderr of
+    their own is copied to ours with each line prefixed by the script's
+    number, so that the scripts' output can be told apart. The other
+    arguments are passed to each Session."""
+
+    def __init__(self, size, sessionBinary, server, quiet=False,
+                 scriptDelay=10, logout=True, recycle=True, maxScripts=None,
+                 readyTimeout=60, prefixOutput=True):
+        if server is None:
+            raise ValueError("A SessionPool needs an X server to start")
+        self.size = size
+        self.sessionBinary = sessionBinary
+        self.server = server
+        self.quiet = quiet
+        self.scriptDelay = scriptDelay
+        self.logout = logout
+        self.recycle = recycle
+        self.maxScripts = maxScripts
+        self.readyTimeout = readyTimeout
+        self.prefixOutput = prefixOutput
+
+    def findFreeDisplays(self, count):
+        """Returns count display names, starting from the one
+        XServer.findFreeDisplay picks and skipping any number that another
+        X server holds a lock file or socket for."""
+        number = int(XServer.findFreeDisplay()[1:])
+        displays = []
+        while len(displays) < count:
+            if not XServer.isDisplayInUse(number):
+                displays.append(':%d' % number)
+            number += 1
+        return displays
+
+    def run(self, scripts):
+        """Runs the given Script objects and returns their exit codes in the
+        same order. The exit code of a script that couldn't be run is None,
+        and the exception that stopped it is in the errors dict under the
+        script's index."""
+        self.queue = Queue.Queue()
+        self.exitCodes = [None] * len(scripts)
+        self.errors = {}
+        for item in enumerate(scripts):
+            self.queue.put(item)
+        displays = self.findFreeDisplays(min(self.size, len(scripts)))
+        workers = [SessionWorker(self, display) for display in displays]
+        for worker in workers:
+            self.queue.put(None)
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.exitCodes
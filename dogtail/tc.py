@@ -11,9 +11,14 @@ import re
 import time
 import datetime
 import os.path
+import atexit
+import cPickle
+try: from hashlib import md5
+except ImportError: from md5 import md5
 from config import config
-from logging import ResultsLogger, TimeStamp, debugLogger
-from PIL import Image, ImageChops, ImageStat
+from logging import ResultsLogger, TimeStamp, debugLogger, getOutcome
+# PIL (for TCImage) and dogtail.tree (for TCNode) are only imported when those
+# are used, so that scripts checking strings don't pay for loading them.
 
 
 class TC(object):
@@ -27,6 +32,30 @@ class TC(object):
         self.supportedtypes = ("ascii", "utf-8", "utf-16", "utf-16-be", "utf-16-le", "unicode-escape", "raw-unicode-escape",
         "big5", "gb18030", "eucJP", "eucKR", "shiftJIS")
 
+    def logResult(self, result, start, node = None):
+        """
+        Log the result of a comparison that started at the given time, along
+        with the details recorded in the structured results log (see
+        ResultsLogger.logStructured): the type of test case, how long the
+        comparison took, and the search path of the node involved, if any.
+
+        If the screen is being recorded (see dogtail.capture), failures also
+        write out the frames recorded since the last failure.
+        """
+        details = None
+        if config.structuredResults:
+            details = {'type': self.__class__.__name__,
+                    'duration': time.time() - start}
+            if node is not None:
+                try: details['node'] = str(node.getAbsoluteSearchPath())
+                except Exception: pass
+        TC.logger.log(result, details)
+        for outcome in result.values():
+            if getOutcome(outcome) != 'passed':
+                import capture
+                capture.dumpFrames()
+                break
+
     # String comparison function
     def compare(self, label, baseline, undertest, encoding=config.encoding):
         """
@@ -40,6 +69,7 @@ class TC(object):
         codecs.open() instead of open(), so the file's encoding may be
         specified.
         """
+        start = time.time()
         self.label = label.strip()
         self.baseline = baseline
         self.undertest = undertest
@@ -58,13 +88,13 @@ class TC(object):
             else:
                 self.result = {self.label: "Failed - " + self.encoding + " strings do not match. " + self.baseline + " expected: Got " + self.undertest}
             # Pass the test result to the ResultsLogger for writing
-            TC.logger.log(self.result)
+            self.logResult(self.result, start)
             return self.result
 
         else:
             # We should probably raise an exception here
             self.result = {self.label: "ERROR - " + self.encoding + " is not a supported encoding type"}
-            TC.logger.log(self.result)
+            self.logResult(self.result, start)
             return self.result
 
 
@@ -77,47 +107,320 @@ class TCString(TC):
         TC.__init__(self)
 
 # Image test case subclass
+def loadImage(image):
+    """
+    Return the given filename, PIL image or gtk.gdk.Pixbuf as a PIL image.
+    """
+    from PIL import Image
+    if isinstance(image, basestring):
+        return Image.open(image.strip())
+    if isinstance(image, Image.Image):
+        return image
+    if hasattr(image, 'get_pixels') and hasattr(image, 'get_rowstride'):
+        if image.get_has_alpha(): mode = 'RGBA'
+        else: mode = 'RGB'
+        size = (image.get_width(), image.get_height())
+        return Image.frombuffer(mode, size, image.get_pixels(), 'raw', mode,
+                image.get_rowstride(), 1)
+    raise TypeError("Need filenames, PIL images or pixbufs!")
+
+def hasAlpha(image):
+    """
+    Does the PIL image have transparency?
+    """
+    return image.mode in ('RGBA', 'LA', 'PA') or \
+            (image.mode == 'P' and 'transparency' in image.info)
+
+def normalizeImages(baseImage, testImage):
+    """
+    Convert both PIL images to RGB, or to RGBA if either has transparency, so
+    that their pixels are compared by colour rather than by e.g. palette
+    index. Returns the converted images.
+    """
+    if hasAlpha(baseImage) or hasAlpha(testImage): mode = 'RGBA'
+    else: mode = 'RGB'
+    if baseImage.mode != mode: baseImage = baseImage.convert(mode)
+    if testImage.mode != mode: testImage = testImage.convert(mode)
+    return baseImage, testImage
+
+def bandTolerances(tolerance, bands):
+    """
+    Get a list with the tolerance for each of the given number of bands,
+    from a single number or a sequence with one number per band.
+    """
+    if isinstance(tolerance, (int, long, float)): return [tolerance] * bands
+    try: tolerances = list(tolerance)
+    except TypeError:
+        raise ValueError("tolerance must be a number or a sequence of them")
+    if len(tolerances) != bands:
+        raise ValueError("tolerance needs %d values, one per band, not %d" %
+                (bands, len(tolerances)))
+    for value in tolerances:
+        if not isinstance(value, (int, long, float)):
+            raise ValueError("tolerance values must be numbers, not %r" %
+                    (value,))
+    return tolerances
+
+def pixelDigest(image):
+    """
+    Return a digest of the size and pixels of the given PIL image, taken in
+    RGBA so that the same picture stored in different modes (RGB, P, RGBA
+    with an opaque alpha channel) digests the same.
+    """
+    if image.mode != 'RGBA': image = image.convert('RGBA')
+    if hasattr(image, 'tobytes'): pixels = image.tobytes()
+    else: pixels = image.tostring()
+    digest = md5("%s %dx%d\n" % ((image.mode,) + image.size))
+    digest.update(pixels)
+    return digest.hexdigest()
+
+def dHash(image, hashSize = 8):
+    """
+    Return the difference hash of the given PIL image as an integer of
+    hashSize * hashSize bits: the image is shrunk to a grayscale thumbnail
+    one pixel wider than hashSize, and each bit says whether a pixel is
+    brighter than its right-hand neighbour. Images that look alike have
+    hashes differing in few bits.
+    """
+    from PIL import Image
+    width = hashSize + 1
+    pixels = list(image.convert('L').resize((width, hashSize),
+            Image.BILINEAR).getdata())
+    value = 0
+    for row in range(hashSize):
+        for column in range(hashSize):
+            left = pixels[row * width + column]
+            right = pixels[row * width + column + 1]
+            value = value << 1 | (left > right)
+    return value
+
+def hammingDistance(a, b):
+    """
+    Return the number of bits that differ between the integers a and b.
+    """
+    difference = a ^ b
+    bits = 0
+    while difference:
+        difference &= difference - 1
+        bits += 1
+    return bits
+
+class ImageHash:
+    """
+    What an ImageHashStore knows about a baseline file.
+    """
+    def __init__(self, stamp, size, digest, hash, thumbnail):
+        self.stamp = stamp
+        self.size = size
+        self.digest = digest
+        self.hash = hash
+        self.thumbnail = thumbnail
+
+class ImageHashStore:
+    """
+    Remembers the pixelDigest, dHash and a thumbnail of baseline image files,
+    recomputing them when a file's modification time or size changes. The
+    index is saved in the store's directory when the process exits, and the
+    thumbnails are written next to it for triaging failures.
+    """
+    thumbnailSize = (64, 64)
+
+    def __init__(self, directory = None):
+        if directory is None:
+            directory = os.path.join(config.dataDir, 'imagehashes')
+        if not os.path.isdir(directory): os.makedirs(directory)
+        self.directory = directory
+        self.indexFile = os.path.join(directory, 'index.pickle')
+        self.hashes = None
+        self.changed = False
+
+    def __load(self):
+        self.hashes = {}
+        atexit.register(self.save)
+        try:
+            indexFile = open(self.indexFile, 'rb')
+            try: self.hashes = cPickle.load(indexFile)
+            finally: indexFile.close()
+        except Exception: pass
+
+    def lookup(self, fileName):
+        """
+        Return the ImageHash of the given image file, computing it if needed.
+        """
+        if self.hashes is None: self.__load()
+        fileName = os.path.abspath(fileName)
+        stat = os.stat(fileName)
+        stamp = (stat.st_mtime, stat.st_size)
+        imageHash = self.hashes.get(fileName)
+        if imageHash is None or imageHash.stamp != stamp:
+            imageHash = self.add(fileName, loadImage(fileName), stamp)
+        return imageHash
+
+    def add(self, fileName, image, stamp):
+        """
+        Compute and remember the ImageHash of the given image, loaded from
+        fileName.
+        """
+        digest = pixelDigest(image)
+        thumbnail = os.path.join(self.directory, "%s.png" %
+                md5(fileName).hexdigest())
+        thumbnailImage = image.copy()
+        thumbnailImage.thumbnail(self.thumbnailSize)
+        thumbnailImage.save(thumbnail)
+        imageHash = ImageHash(stamp, image.size, digest, dHash(image),
+                thumbnail)
+        self.hashes[fileName] = imageHash
+        self.changed = True
+        return imageHash
+
+    def save(self):
+        """
+        Save the index, if anything was added to it.
+        """
+        if not self.changed: return
+        tempFile = "%s.%d" % (self.indexFile, os.getpid())
+        try:
+            indexFile = open(tempFile, 'wb')
+            try: cPickle.dump(self.hashes, indexFile, 2)
+            finally: indexFile.close()
+            os.rename(tempFile, self.indexFile)
+            self.changed = False
+        except (IOError, OSError, cPickle.PicklingError):
+            debugLogger.log("Warning: Failed to save image hashes")
+
+imageHashStore = None
+
+def getImageHashStore():
+    """
+    Get the ImageHashStore, creating it if needed.
+    """
+    global imageHashStore
+    if imageHashStore is None: imageHashStore = ImageHashStore()
+    return imageHashStore
+
 class TCImage(TC):
     """
     Image Test Case Class.
+
+    Two images of the same size match if no more than maxDiffRatio of their
+    pixels have a channel differing by more than tolerance, which is either a
+    single number or a sequence with one number per channel. They default to
+    config.imageTolerance and config.imageMaxDiffRatio, which require the
+    images to be identical. The images are compared in RGB, or in RGBA if
+    either has transparency, whatever modes they were stored in.
+
+    Either image may be given as a filename, a PIL image or a gtk.gdk.Pixbuf,
+    such as one returned by Node.screenshot(inMemory = True).
+
+    With config.useImageHashes set, a baseline given as a filename is looked
+    up in the ImageHashStore first: an image with the same pixels passes
+    without the baseline being loaded; any other image is compared pixel by
+    pixel as usual, and if that fails the message also gives how many bits
+    of its dHash differ from the baseline's, and the baseline's thumbnail.
+
+    If NumPy is available, the pixels are compared tileRows rows at a time,
+    stopping at the first tile that takes the number of differing pixels over
+    the limit; otherwise PIL compares them one channel at a time. The diff
+    image is only written when the comparison fails.
     """
-    def compare(self, label, baseline, undertest):
-        for _file in (baseline, undertest):
-            if type(_file) is not unicode and type(_file) is not str:
-                raise TypeError("Need filenames!")
+    tileRows = 64
+
+    def compare(self, label, baseline, undertest, tolerance = None,
+            maxDiffRatio = None):
+        start = time.time()
         self.label = label.strip()
-        self.baseline = baseline.strip()
-        self.undertest = undertest.strip()
+        self.baseline = baseline
+        self.undertest = undertest
+        if tolerance is None: tolerance = config.imageTolerance
+        if maxDiffRatio is None: maxDiffRatio = config.imageMaxDiffRatio
         diffName = TimeStamp().fileStamp("diff") + ".png"
         self.diff = os.path.normpath(
                 os.path.sep.join((config.scratchDir, diffName)))
 
-        self.baseImage = Image.open(self.baseline)
-        self.testImage = Image.open(self.undertest)
-        try:
-            if self.baseImage.size != self.testImage.size: 
-                self.result = {self.label: "Failed - images are different sizes"}
-                raise StopIteration
-
-            self.diffImage = ImageChops.difference(self.baseImage, 
+        self.testImage = loadImage(self.undertest)
+        self.baseImage = None
+        imageHash = None
+        if config.useImageHashes and isinstance(self.baseline, basestring):
+            imageHash = getImageHashStore().lookup(self.baseline.strip())
+            size = imageHash.size
+        else:
+            self.baseImage = loadImage(self.baseline)
+            size = self.baseImage.size
+        if size != self.testImage.size: 
+            self.result = {self.label: "Failed - images are different sizes"}
+        elif imageHash is not None and imageHash.digest == pixelDigest(self.testImage):
+            self.result = {self.label: "Passed"}
+        else:
+            if self.baseImage is None:
+                self.baseImage = loadImage(self.baseline)
+            self.baseImage, self.testImage = normalizeImages(self.baseImage,
                     self.testImage)
-            self.diffImage.save(self.diff)
-            result = False
-            for stat in ('stddev', 'mean', 'sum2'):
-                for item in getattr(ImageStat.Stat(self.diffImage), stat):
-                    if item: 
-                        self.result = {self.label: "Failed - see %s" % 
-                                self.diff}
-                        raise StopIteration
-                    else: result = True
-        except StopIteration:
-            result = False
-
-        if result: self.result = {self.label: "Passed"}
-
-        TC.logger.log(self.result)
+            tolerances = bandTolerances(tolerance, len(self.baseImage.mode))
+            width, height = self.baseImage.size
+            allowed = int(maxDiffRatio * width * height)
+            differing = self.countDifferingPixels(self.baseImage,
+                    self.testImage, tolerances, allowed)
+            if differing <= allowed:
+                self.result = {self.label: "Passed"}
+            else:
+                self.writeDiff()
+                message = "Failed - more than %d pixels differ - see %s" % (allowed, self.diff)
+                if imageHash is not None:
+                    distance = hammingDistance(imageHash.hash, dHash(self.testImage))
+                    message += " (%d hash bits differ, baseline thumbnail %s)" % (
+                            distance, imageHash.thumbnail)
+                self.result = {self.label: message}
+
+        self.logResult(self.result, start)
         return self.result
 
+    def countDifferingPixels(self, baseImage, testImage, tolerances, allowed):
+        """
+        Count the pixels of the two images (of the same size and mode) that
+        have a channel differing by more than its tolerance (from the list
+        returned by bandTolerances), stopping as soon as the count is over
+        allowed.
+        """
+        try: import numpy
+        except ImportError: numpy = None
+        if numpy is None:
+            return self.__countDifferingPixelsPIL(baseImage, testImage,
+                    tolerances)
+
+        baseArray = numpy.asarray(baseImage)
+        testArray = numpy.asarray(testImage)
+        if baseArray.ndim == 2:
+            baseArray = baseArray[:, :, numpy.newaxis]
+            testArray = testArray[:, :, numpy.newaxis]
+        tolerances = numpy.asarray(tolerances)
+        differing = 0
+        for top in range(0, baseArray.shape[0], self.tileRows):
+            baseTile = baseArray[top:top + self.tileRows].astype(numpy.int16)
+            testTile = testArray[top:top + self.tileRows].astype(numpy.int16)
+            pixels = (numpy.abs(baseTile - testTile) > tolerances).any(axis = 2)
+            differing += int(pixels.sum())
+            if differing > allowed: break
+        return differing
+
+    def __countDifferingPixelsPIL(self, baseImage, testImage, tolerances):
+        from PIL import ImageChops
+        bands = ImageChops.difference(baseImage, testImage).split()
+        # Mark the pixels over the tolerance in any band with 255:
+        mask = None
+        for band, bandTolerance in zip(bands, tolerances):
+            band = band.point(lambda value: (value > bandTolerance) * 255)
+            if mask is None: mask = band
+            else: mask = ImageChops.lighter(mask, band)
+        return mask.histogram()[255]
+
+    def writeDiff(self):
+        """
+        Save the difference between the images in self.diff.
+        """
+        from PIL import ImageChops
+        self.diffImage = ImageChops.difference(self.baseImage, self.testImage)
+        self.diffImage.save(self.diff)
+
 
 class TCNumber(TC):
     """
@@ -133,6 +436,7 @@ class TCNumber(TC):
         Compares 2 numbers to see if they are the same. The user may specify
         how to normalize mixed type comparisons via the type argument.
         """
+        start = time.time()
         self.label = label.strip()
         self.baseline = baseline
         self.undertest = undertest
@@ -159,11 +463,11 @@ class TCNumber(TC):
                 self.result = {self.label: "Passed - numbers are the same"}
             else:
                 self.result = {self.label: "Failed - " + str(self.baseline) + " expected: Got " + str(self.undertest)}
-            TC.logger.log(self.result)
+            self.logResult(self.result, start)
             return self.result
         else:
             self.result = {self.label: "Failed - " + self.type + " is not in list of supported types"}
-            TC.logger.log(self.result)
+            self.logResult(self.result, start)
             return self.result
 
 class TCBool(TC):
@@ -174,12 +478,12 @@ class TCBool(TC):
         If _bool is True, pass.
         If _bool is False, fail.
         """
+        start = time.time()
         if type(_bool) is not bool: raise TypeError
         if _bool: result = {label: "Passed"}
         else: result = {label: "Failed"}
-        TC.logger.log(result)
+        self.logResult(result, start)
 
-from tree import Node
 class TCNode(TC):
     def __init__(self): pass
 
@@ -188,6 +492,8 @@ class TCNode(TC):
         If baseline is None, simply check that undertest is a Node.
         If baseline is a Node, check that it is equal to undertest.
         """
+        start = time.time()
+        from tree import Node
         if baseline is not None and not isinstance(baseline, Node): 
             raise TypeError
 
@@ -199,7 +505,8 @@ class TCNode(TC):
             if baseline == undertest: 
                 result = {label: "Passed - %s == %s" % (baseline, undertest)}
             else: result = {label: "Failed - %s != %s" % (baseline, undertest)}
-        TC.logger.log(result)
+        if isinstance(undertest, Node): self.logResult(result, start, undertest)
+        else: self.logResult(result, start)
 
 
 if __name__ == '__main__':
@@ -382,6 +689,18 @@ if __name__ == '__main__':
     # Print the result Should be label - Passed
     print result
 
+    # Compare different colors, allowing any difference
+    label = "unit test case 3.3"
+    baseline = "../examples/data/20w.png"
+    undertest = "../examples/data/20b.png"
+    result = {}
+
+    # Fire off the compare
+    result = case3.compare(label, baseline, undertest, tolerance = 255)
+
+    # Print the result Should be label - Passed
+    print result
+
     # Number comparison tests
     label = "unit test case 4.0"
     baseline = 42
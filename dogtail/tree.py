@@ -65,14 +65,24 @@ if config.checkForA11y:
     from utils import checkForA11y
     checkForA11y()
 
+if config.captureFrames:
+    import capture
+    capture.startRecorder()
+
 import re
 import predicate
+import i18n
 from datetime import datetime
+import time
 from time import sleep
+from collections import deque
+from itertools import islice
 from utils import doDelay
 from utils import Blinker
 import rawinput
 import path
+import events
+import metrics
 
 from logging import debugLogger as logger
 
@@ -84,14 +94,18 @@ except ImportError:
 
 from CORBA import COMM_FAILURE, OBJECT_NOT_EXIST
 
-# We optionally import the bindings for libwnck.
-try:
-    import wnck
-    gotWnck = True
-except ImportError:
-    # Skip this warning, since the functionality is almost entirely nonworking anyway.
-    #print "Warning: Dogtail could not import the Python bindings for libwnck. Window-manager manipulation will not be available."
-    gotWnck = False
+def importWnck():
+    """
+    We optionally use the bindings for libwnck, importing them the first time
+    they are needed. Returns the wnck module, or None if it isn't available.
+    """
+    try:
+        import wnck
+        return wnck
+    except ImportError:
+        # Skip this warning, since the functionality is almost entirely nonworking anyway.
+        #print "Warning: Dogtail could not import the Python bindings for libwnck. Window-manager manipulation will not be available."
+        return None
 
 haveWarnedAboutChildrenLimit = False
 
@@ -155,6 +169,7 @@ class Action:
         return "[action | %s | %s ]" % \
             (self.name, self.keyBinding)
 
+    @metrics.timed('tree.action', lambda self: self.name)
     def do (self):
         """
         Performs the given tree.Action, with appropriate delays and logging.
@@ -168,7 +183,7 @@ class Action:
                 logger.log("Warning: " + str(nSE))
         if config.blinkOnActions: self.node.blink()
         result = self.__action.doAction (self.__index)
-        doDelay(config.actionDelay)
+        doDelay(config.actionDelay, self.node)
         return result
 
 
@@ -214,47 +229,55 @@ class Node:
     @property
     def children(self):
         """a list of this Accessible's children"""
+        return list(self.iterChildren(limit = True))
+
+    def iterChildren(self, limit = False):
+        """
+        Generate this Accessible's children (the same ones, in the same order,
+        as the 'children' property), reading each one only when it is asked
+        for. Only the 'children' property passes limit = True to stop after
+        config.childrenLimit of them.
+        """
         if self.parent and self.parent.roleName == 'hyper link':
             print self.parent.role
-            return []
-        children = []
+            return
+        numChildren = 0
         childCount = self.childCount
-        if childCount > config.childrenLimit:
-            global haveWarnedAboutChildrenLimit
-            if not haveWarnedAboutChildrenLimit:
-                logger.log("Only returning %s children. You may change "
-                    "config.childrenLimit if you wish. This message will only"
-                    " be printed once." % str(config.childrenLimit))
-                haveWarnedAboutChildrenLimit = True
-                childCount = config.childrenLimit
+        if limit: childCount = limitChildCount(childCount)
         for i in range(childCount):
             # Workaround for GNOME bug #465103
             # also solution for GNOME bug #321273
             try:
                 child = self[i]
             except LookupError: child = None
-            if child: children.append(child)
+            if child:
+                numChildren += 1
+                yield child
 
-        invalidChildren = childCount - len(children)
+        invalidChildren = childCount - numChildren
         if invalidChildren and config.debugSearching:
             logger.log("Skipped %s invalid children of %s" % \
                     (invalidChildren, str(self)))
-        try:
-            ht = self.queryHypertext()
-            for li in range(ht.getNLinks()):
-                link = ht.getLink(li)
-                for ai in range(link.nAnchors):
-                    child = link.getObject(ai)
-                    child.__setupUserData()
-                    child.user_data['linkAnchor'] = \
-                            LinkAnchor(node = child, \
-                                        hypertext = ht, \
-                                        linkIndex = li, \
-                                        anchorIndex = ai )
-                    children.append(child)
-        except NotImplementedError: pass
-
-        return children
+        for child in self._iterLinkAnchors(): yield child
+
+    def _iterLinkAnchors(self):
+        """
+        Generate the objects anchored by this Accessible's hypertext links,
+        which come after its real children in the 'children' property.
+        """
+        try: ht = self.queryHypertext()
+        except NotImplementedError: return
+        for li in range(ht.getNLinks()):
+            link = ht.getLink(li)
+            for ai in range(link.nAnchors):
+                child = link.getObject(ai)
+                child.__setupUserData()
+                child.user_data['linkAnchor'] = \
+                        LinkAnchor(node = child, \
+                                    hypertext = ht, \
+                                    linkIndex = li, \
+                                    anchorIndex = ai )
+                yield child
 
     roleName = property(Accessibility.Accessible.getRoleName)
 
@@ -304,7 +327,7 @@ class Node:
             logger.log("Setting combobox %s to '%s'"%(self.getLogString(),
                 value))
             self.childNamed(childName=value).doAction('click')
-            doDelay()
+            doDelay(node = self)
 
         return property(**locals())
 
@@ -418,6 +441,19 @@ class Node:
             blinkData = Blinker(x, y, w, h, count)
             return True
 
+    def screenshot(self, file = 'screenshot.png', timeStamp = True,
+            inMemory = False):
+        """
+        Take a screenshot of just this Accessible's extents. See
+        dogtail.utils.screenshot for the arguments.
+        """
+        extents = self.extents
+        if not extents:
+            raise ValueError, "%s has no extents" % self.getLogString()
+        from utils import screenshot
+        return screenshot(file, timeStamp, region = extents,
+                inMemory = inMemory)
+
     def click(self, button = 1):
         """
         Generates a raw mouse click event, using the specified button.
@@ -512,13 +548,13 @@ class Node:
     def selectAll(self):
         """Selects all children."""
         result = self.querySelection().selectAll()
-        doDelay()
+        doDelay(node = self)
         return result
 
     def deselectAll(self):
         """Deselects all selected children."""
         result = self.querySelection().clearSelection()
-        doDelay()
+        doDelay(node = self)
         return result
 
     def select(self):
@@ -526,7 +562,7 @@ class Node:
         try: parent = self.parent
         except AttributeError: raise NotImplementedError
         result = parent.querySelection().selectChild(self.indexInParent)
-        doDelay()
+        doDelay(node = self)
         return result
 
     def deselect(self):
@@ -534,7 +570,7 @@ class Node:
         try: parent = self.parent
         except AttributeError: raise NotImplementedError
         result = parent.querySelection().deselectChild(self.indexInParent)
-        doDelay()
+        doDelay(node = self)
         return result
 
     @property
@@ -594,17 +630,34 @@ class Node:
         """
         logger.log("Typing text into %s: '%s'"%(self.getLogString(), string))
 
-        if self.focusable:
-            if not self.focused:
-                try: self.grabFocus()
-                except Exception: logger.log("Node is focusable but I can't grabFocus!")
+        focusable = self.focusable
+        if focusable and not self.focused:
+            try: self.grabFocus()
+            except Exception: logger.log("Node is focusable but I can't grabFocus!")
+
+        if config.bulkTyping:
+            try: et = self.queryEditableText()
+            except NotImplementedError: et = None
+            if et is not None:
+                self.__insertText(et, string)
+                return
+
+        if focusable:
             rawinput.typeText(string)
         else:
             logger.log("Node is not focusable; falling back to inserting text")
-            et = self.queryEditableText()
-            et.insertText(self.caretOffset, string, len(string))
-            self.caretOffset += len(string)
-            doDelay()
+            self.__insertText(self.queryEditableText(), string)
+
+    def __insertText(self, et, string):
+        """
+        Insert the text at the caret through the EditableText interface, and
+        move the caret past it. AT-SPI counts the length in characters, not
+        in the bytes of the UTF-8 string it is sent.
+        """
+        text = i18n.safeDecode(string)
+        et.insertText(self.caretOffset, text.encode('utf-8'), len(text))
+        self.caretOffset += len(text)
+        doDelay(node = self)
 
     def keyCombo(self, comboString):
         if config.debugSearching: logger.log("Pressing keys '%s' into %s"%(combo, self.getLogString()))
@@ -661,22 +714,37 @@ class Node:
         if config.debugSearchPaths:
             logger.log("getAbsoluteSearchPath(%s)" % self)
 
+        if config.cacheSearchPaths:
+            cache = getSearchPathCache()
+            cachedPath = cache.get(self)
+            if cachedPath is not None: return cachedPath.copy()
+
+        # The nodes whose renaming or moving would change the path:
+        pathNodes = [self]
         if self.roleName=='application':
             result =path.SearchPath()
             result.append(predicate.IsAnApplicationNamed(self.name), False)
-            return result
         else:
             if self.parent:
                 (ancestor, pred, isRecursive) = self.getRelativeSearch()
                 if config.debugSearchPaths:
                     logger.log("got ancestor: %s" % ancestor)
 
-                ancestorPath = ancestor.getAbsoluteSearchPath()
-                ancestorPath.append(pred, isRecursive)
-                return ancestorPath
+                result = ancestor.getAbsoluteSearchPath()
+                result.append(pred, isRecursive)
+                if config.cacheSearchPaths:
+                    node = self.parent
+                    while node is not None and node != ancestor:
+                        pathNodes.append(node)
+                        node = node.parent
+                    pathNodes.append(ancestor)
             else:
                 # This should be the root node:
-                return path.SearchPath()
+                result = path.SearchPath()
+
+        if config.cacheSearchPaths:
+            cache.add(self, result.copy(), pathNodes)
+        return result
 
     def getRelativeSearch(self):
         """
@@ -732,25 +800,340 @@ class Node:
         else:
             return False
 
-    def _fastFindChild(self, pred, recursive = True):
+    def getChildAttributes(self, fields = ('roleName', 'name', 'states',
+            'childCount')):
+        """
+        Read the given attributes of all children of this node in a single
+        pass, returning a list of (child, values) pairs, where values is a
+        dictionary keyed by field name. The 'states' field gives the list of
+        states in the child's state set. Children that go away while being
+        read are left out.
+
+        With config.cacheProperties set, pyatspi answers most of these from
+        its cache, which is kept up to date by the events delivered to it.
+        """
+        applyCacheLevel()
+        if config.cacheProperties: events.pump()
+        callsBefore = SearchNode.calls
+        result = []
+        for child in self._searchChildren(SearchNode(self)):
+            values = {}
+            try:
+                for field in fields:
+                    if field == 'states':
+                        SearchNode.calls += 1
+                        values[field] = child.node.getState().getStates()
+                    else: values[field] = getattr(child, field)
+            except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): continue
+            result.append((child.node, values))
+        metrics.count('ipc.calls', SearchNode.calls - callsBefore)
+        if config.debugSearching:
+            logger.log("reading children of %s made %i AT-SPI calls" % \
+                    (self.getLogString(), SearchNode.calls - callsBefore))
+        return result
+
+    def _getSearchIndex(self, pred):
+        """
+        Get the SearchIndex that searches below this node for the given
+        predicate should use, or None if they should walk the tree.
+        """
+        if not config.useSearchIndex: return None
+        if pred.indexKeys() is None: return None
+        try:
+            application = self.getApplication()
+            if application is None and self.roleName == 'application':
+                application = self
+        except (NotImplementedError, LookupError, COMM_FAILURE,
+                OBJECT_NOT_EXIST):
+            return None
+        if application is None: return None
+        return getSearchIndex(application)
+
+    def _fastFindChild(self, pred, recursive = True, maxDepth = None,
+            showingOnly = None):
+        """
+        Searches for an Accessible by walking the tree with _iterSearch in the
+        order given by config.searchStrategy, or through the application's
+        SearchIndex (taking the first match it holds) if
+        config.useSearchIndex is set and the predicate allows it.
+        """
+        if isinstance(pred, predicate.Predicate):
+            index = self._getSearchIndex(pred)
+            if index is not None:
+                for result in index.find(self, pred, recursive, maxDepth,
+                        showingOnly, None):
+                    return result
+                return None
+        callsBefore = SearchNode.calls
+        result = None
+        for result in self._iterSearch(pred, recursive,
+                config.searchStrategy, maxDepth, showingOnly): break
+        metrics.count('ipc.calls', SearchNode.calls - callsBefore)
+        if config.debugSearching:
+            logger.log("search made %i AT-SPI calls" % \
+                    (SearchNode.calls - callsBefore))
+        return result
+
+    def _searchChildren(self, searchNode):
+        """
+        Generate SearchNodes for the children of the given SearchNode (the
+        same ones as iterChildren gives, hypertext link anchors included, and
+        all of them regardless of config.childrenLimit), reading each child
+        only when it is asked for, and stopping if the node goes away.
         """
-        Searches for an Accessible using methods from pyatspi.utils
+        try:
+            parent = searchNode.searchParent
+            if parent is None: parent = SearchNode(searchNode.parent)
+            if parent.node is not None and parent.roleName == 'hyper link':
+                return
+            childCount = searchNode.childCount
+        except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): return
+        for i in range(childCount):
+            SearchNode.calls += 1
+            # Skip children that can't be read, as iterChildren does
+            try: child = searchNode.node.getChildAtIndex(i)
+            except LookupError: continue
+            except (COMM_FAILURE, OBJECT_NOT_EXIST): return
+            if child: yield SearchNode(child, searchNode)
+        SearchNode.calls += 1
+        try:
+            for child in searchNode.node._iterLinkAnchors():
+                SearchNode.calls += 1
+                yield SearchNode(child, searchNode)
+        except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): return
+
+    # The orders in which _iterSearch can walk the tree:
+    searchStrategies = ('dfs', 'bfs', 'iterative-deepening')
+
+    def _iterSearch(self, pred, recursive = True, order = 'dfs',
+            maxDepth = None, showingOnly = None):
+        """
+        Generate the children (or if recursive is True, descendents) of this
+        node that satisfy the predicate, walking the tree in the given order:
+
+            - 'dfs' is depth-first, the same order as
+              pyatspi.utils.findDescendant's.
+            - 'bfs' is breadth-first: all of the nodes at one depth are
+              visited before any below them.
+            - 'iterative-deepening' does depth-first walks limited to one level,
+              then two, and so on. It finds the same nodes first as 'bfs' does
+              while only keeping one branch in memory, at the cost of visiting
+              the upper levels again on each walk.
+
+        If maxDepth is given, nodes more than that many levels below this one
+        are not visited. If showingOnly is True (or is None, and the predicate
+        has a true showingOnly attribute), nodes that aren't both SHOWING and
+        VISIBLE are skipped along with their whole subtree. The tree is only
+        walked as far as the consumer asks for results.
+
+        Predicates that declare their fields are run against SearchNodes, so
+        each node visited only costs the AT-SPI calls needed to read those
+        fields (and its children).
+        """
+        if order not in self.searchStrategies:
+            raise ValueError, "Unknown search order %r" % order
+        applyCacheLevel()
+        if config.cacheProperties: events.pump()
+        showingOnly = wantsShowingOnly(pred, showingOnly)
+        if isinstance(pred, predicate.Predicate):
+            wrap = pred.fields is not None
+            pred = pred.satisfiedByNode
+        else: wrap = False
+        if not recursive: maxDepth = 1
+        if order != 'iterative-deepening':
+            for node in self._walk(pred, wrap, order == 'bfs', maxDepth,
+                    showingOnly = showingOnly):
+                yield node
+            return
+        depthLimit = 1
+        while True:
+            truncated = []
+            for node in self._walk(pred, wrap, False, depthLimit, depthLimit,
+                    truncated, showingOnly):
+                yield node
+            if not truncated: return
+            if maxDepth is not None and depthLimit >= maxDepth: return
+            depthLimit += 1
+
+    def _walk(self, pred, wrap, breadthFirst, maxDepth, minDepth = 1,
+            truncated = None, showingOnly = False):
+        """
+        Internal helper for _iterSearch, which walks the tree once. Only nodes
+        at least minDepth levels below this one are checked against the
+        predicate. If a list is given as truncated, something is appended to
+        it if the walk stopped at maxDepth above a node that has children.
+        If showingOnly is True, the state set of each node is checked once,
+        and the node and its subtree skipped if it isn't showing.
+        """
+        root = SearchNode(self)
+        # The children still to be visited, as (iterator, depth) pairs: the
+        # oldest iterator is taken from first when walking breadth-first, the
+        # newest when walking depth-first, and nothing is read from AT-SPI
+        # until it is needed.
+        pending = deque([(iter([root]), 0)])
+        while pending:
+            if breadthFirst: children, depth = pending[0]
+            else: children, depth = pending[-1]
+            try: searchNode = children.next()
+            except StopIteration:
+                if breadthFirst: pending.popleft()
+                else: pending.pop()
+                continue
+            if showingOnly and searchNode is not root:
+                try: showing = searchNode.isShowing()
+                except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST):
+                    showing = False
+                if not showing: continue
+            if depth >= minDepth:
+                if wrap: candidate = searchNode
+                else: candidate = searchNode.node
+                # Nodes that die while being checked don't match, but any
+                # other error (e.g. a bug in the predicate) is the caller's.
+                try: matched = pred(candidate)
+                except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST):
+                    matched = False
+                if matched: yield searchNode.node
+            if maxDepth is not None and depth >= maxDepth:
+                if truncated is not None and not truncated:
+                    try:
+                        if searchNode.childCount: truncated.append(searchNode)
+                    except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST):
+                        pass
+                continue
+            pending.append((self._searchChildren(searchNode), depth + 1))
+
+    def iterDescendants(self, pred = None, order = 'dfs', maxDepth = None,
+            showingOnly = None):
+        """
+        Generate the descendents of this node that satisfy the predicate (a
+        Predicate or any function taking a node), or all of them if pred is
+        None. The tree is walked lazily, so stopping early (e.g. by breaking
+        out of a loop) stops the walk.
+
+        order is 'dfs' (depth-first, the default), 'bfs' (breadth-first) or
+        'iterative-deepening'; see config.searchStrategy. If maxDepth is given,
+        only nodes down to that many levels below this one are visited; 1
+        means children only. If showingOnly is True, subtrees whose root isn't
+        showing are skipped.
+        """
+        if order not in self.searchStrategies:
+            raise ValueError, "Unknown search order %r" % order
+        if pred is None: pred = lambda node: True
+        return self._iterSearch(pred, True, order, maxDepth, showingOnly)
+
+    def _depthOf(self, node, maxDepth = None, showingOnly = False):
+        """
+        Get the number of levels the given node is below this one, or None if
+        it isn't a descendent of this node (no more than maxDepth levels
+        down). If showingOnly is True, None is also returned if the node or
+        any of its ancestors below this one isn't showing, as a search with
+        showingOnly set wouldn't reach it.
+        """
+        depth = 1
+        try:
+            if showingOnly and not isShowing(node.getState()): return None
+            parent = node.parent
+        except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): return None
+        while parent is not None:
+            if parent == self: return depth
+            if maxDepth is not None and depth >= maxDepth: return None
+            depth += 1
+            try:
+                if showingOnly and not isShowing(parent.getState()):
+                    return None
+                parent = parent.parent
+            except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): return None
+        return None
+
+    def _isAncestorOf(self, node, recursive = True, maxDepth = None):
+        """
+        Is this node the parent (or if recursive is True, any ancestor no more
+        than maxDepth levels up) of the given node?
+        """
+        if not recursive: maxDepth = 1
+        return self._depthOf(node, maxDepth) is not None
+
+    def _waitForChild(self, pred, recursive, description, maxDepth = None,
+            showingOnly = None):
         """
-        if isinstance(pred, predicate.Predicate): pred = pred.satisfiedByNode
-        if not recursive:
-            cIter = iter(self)
+        Search once, then wait for AT-SPI events announcing new or renamed
+        nodes below this one, checking only those against the predicate.
+        Returns None if nothing turned up before the search would have been
+        given up on by findChild.
+        """
+        showingOnly = wantsShowingOnly(pred, showingOnly)
+        eventTypes = ['object:children-changed', 'window:create',
+                'object:property-change:accessible-name']
+        # Nodes coming on screen only matter to searches that skip hidden
+        # ones; listening for them otherwise would just add traffic.
+        if showingOnly: eventTypes.append('object:state-changed:showing')
+        queue = events.EventQueue(tuple(eventTypes))
+        try:
+            if config.debugSearching:
+                logger.log("searching for %s" % description)
+            result = self._fastFindChild(pred, recursive, maxDepth, showingOnly)
+            if result: return result
+
+            timeout = config.searchCutoffCount * config.searchBackoffDuration
+            deadline = time.time() + timeout
             while True:
-                try: child = cIter.next()
-                except StopIteration: break
-                if child is not None:
-                    if pred(child): return child
-        else: return pyatspi.utils.findDescendant(self, pred)
+                remaining = deadline - time.time()
+                if remaining <= 0: break
+                if config.debugSearching or config.debugSleep:
+                    logger.log("waiting up to %f for %s" % (remaining, description))
+                for event in queue.get(remaining):
+                    try:
+                        if event.type.major == 'children-changed':
+                            if event.type.minor != 'add': continue
+                            candidate = event.any_data
+                            searchBelow = recursive
+                        elif event.type.major == 'create':
+                            candidate = event.source
+                            searchBelow = recursive
+                        elif event.type.major == 'state-changed':
+                            # A node that was hidden has come on screen, and
+                            # with it everything below it.
+                            if not event.detail1: continue
+                            candidate = event.source
+                            searchBelow = recursive
+                        else:
+                            candidate = event.source
+                            searchBelow = False
+                        if not isinstance(candidate, Node): continue
+                        if not recursive: maxDepth = 1
+                        depth = self._depthOf(candidate, maxDepth,
+                                showingOnly)
+                        if depth is None: continue
+                        if pred.satisfiedByNode(candidate): return candidate
+                        if searchBelow:
+                            if maxDepth is None: depthBelow = None
+                            else: depthBelow = maxDepth - depth
+                            if depthBelow == 0: continue
+                            result = candidate._fastFindChild(
+                                    pred.satisfiedByNode, True, depthBelow,
+                                    showingOnly)
+                            if result: return result
+                    except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST):
+                        # The new node went away again before we got to it.
+                        pass
+            return None
+        finally:
+            queue.close()
 
+    @metrics.timed('tree.search', lambda self, pred, *args, **kwargs:
+            pred.__class__.__name__)
     def findChild(self, pred, recursive = True, debugName = None, \
-            retry = True, requireResult = True):
+            retry = True, requireResult = True, maxDepth = None,
+            showingOnly = None):
         """
         Search for a node satisyfing the predicate, returning a Node.
 
+        The tree is walked in the order given by config.searchStrategy. If
+        maxDepth is given, nodes more than that many levels below this one
+        are not searched. If showingOnly is True, or is None and the predicate
+        has a true showingOnly attribute, nodes that aren't showing are
+        skipped along with everything below them.
+
         If retry is True (the default), it makes multiple attempts,
         backing off and retrying on failure, and eventually raises a
         descriptive exception if the search fails.
@@ -759,6 +1142,11 @@ class Node:
 
         If requireResult is True (the default), an exception is raised after all
         attempts have failed. If it is false, the function simply returns None.
+
+        If config.eventDrivenSearch is True, retrying is done by waiting for
+        AT-SPI events instead of sleeping; only newly-added or renamed nodes
+        are checked against the predicate, and the search returns as soon as
+        one of them matches.
         """
         def describeSearch (parent, pred, recursive, debugName):
             """
@@ -770,13 +1158,26 @@ class Node:
             return "%s of %s: %s"%(noun, parent.getLogString(), debugName)
 
         assert isinstance(pred, predicate.Predicate)
+        if retry and config.eventDrivenSearch:
+            result = self._waitForChild(pred, recursive,
+                    describeSearch(self, pred, recursive, debugName), maxDepth,
+                    showingOnly)
+            if result:
+                if debugName: result.debugName = debugName
+                else: result.debugName = pred.describeSearchResult()
+                return result
+            if requireResult:
+                raise SearchError(describeSearch(self, pred, recursive, debugName))
+            return None
+
         numAttempts = 0
         while numAttempts < config.searchCutoffCount:
             if numAttempts >= config.searchWarningThreshold or config.debugSearching:
                 logger.log("searching for %s (attempt %i)" % \
                         (describeSearch(self, pred, recursive, debugName), numAttempts))
 
-            result = self._fastFindChild(pred.satisfiedByNode, recursive)
+            result = self._fastFindChild(pred, recursive, maxDepth,
+                    showingOnly)
             if result:
                 assert isinstance(result, Node)
                 if debugName: result.debugName = debugName
@@ -785,6 +1186,7 @@ class Node:
             else:
                 if not retry: break
                 numAttempts += 1
+                metrics.count('tree.search.retries')
                 if config.debugSearching or config.debugSleep:
                     logger.log("sleeping for %f" % config.searchBackoffDuration)
                 sleep(config.searchBackoffDuration)
@@ -792,20 +1194,28 @@ class Node:
             raise SearchError(describeSearch(self, pred, recursive, debugName))
 
     # The canonical "search for multiple" method:
-    def findChildren(self, pred, recursive = True):
+    def findChildren(self, pred, recursive = True, limit = None,
+            maxDepth = None, showingOnly = None):
         """
         Find all children/descendents satisfying the predicate.
-        """
-        if isinstance(pred, predicate.Predicate): pred = pred.satisfiedByNode
-        if not recursive:
-            cIter = iter(self)
-            result = []
-            while True:
-                try: child = cIter.next()
-                except StopIteration: break
-                if child is not None and pred(child): result.append(child)
-            return result
-        else: return pyatspi.utils.findAllDescendants(self, pred)
+
+        If limit is given, stop searching once that many have been found. If
+        maxDepth is given, nodes more than that many levels below this one
+        are not searched. showingOnly works as it does for findChild.
+        """
+        if isinstance(pred, predicate.Predicate):
+            index = self._getSearchIndex(pred)
+            if index is not None:
+                return list(islice(index.find(self, pred, recursive, maxDepth,
+                    showingOnly), limit))
+        callsBefore = SearchNode.calls
+        result = list(islice(self._iterSearch(pred, recursive, 'dfs',
+            maxDepth, showingOnly), limit))
+        metrics.count('ipc.calls', SearchNode.calls - callsBefore)
+        if config.debugSearching:
+            logger.log("search made %i AT-SPI calls" % \
+                    (SearchNode.calls - callsBefore))
+        return result
 
     # The canonical "search above this node" method:
     def findAncestor (self, pred):
@@ -824,8 +1234,15 @@ class Node:
         return None
 
 
+    def snapshot(self):
+        """
+        Take a TreeSnapshot of this node and its descendents, for running
+        many searches against without querying AT-SPI for every node.
+        """
+        return TreeSnapshot(self)
+
     # Various wrapper/helper search methods:
-    def child (self, name = '', roleName = '', description= '', label = '', recursive=True, debugName=None):
+    def child (self, name = '', roleName = '', description= '', label = '', recursive=True, debugName=None, maxDepth=None, showingOnly=None):
         """
         Finds a child satisying the given criteria.
 
@@ -833,9 +1250,9 @@ class Node:
         if no such child is found, and will eventually raise an exception. It
         also logs the search.
         """
-        return self.findChild (predicate.GenericPredicate(name = name, roleName = roleName, description= description, label = label), recursive = recursive, debugName=debugName)
+        return self.findChild (predicate.GenericPredicate(name = name, roleName = roleName, description= description, label = label), recursive = recursive, debugName=debugName, maxDepth=maxDepth, showingOnly=showingOnly)
 
-    def menu(self, menuName, recursive=True):
+    def menu(self, menuName, recursive=True, maxDepth=None):
         """
         Search below this node for a menu with the given name.
 
@@ -843,9 +1260,9 @@ class Node:
         if no such child is found, and will eventually raise an exception. It
         also logs the search.
         """
-        return self.findChild (predicate.IsAMenuNamed(menuName=menuName), recursive)
+        return self.findChild (predicate.IsAMenuNamed(menuName=menuName), recursive, maxDepth=maxDepth)
 
-    def menuItem(self, menuItemName, recursive=True):
+    def menuItem(self, menuItemName, recursive=True, maxDepth=None):
         """
         Search below this node for a menu item with the given name.
 
@@ -853,9 +1270,9 @@ class Node:
         if no such child is found, and will eventually raise an exception. It
         also logs the search.
         """
-        return self.findChild (predicate.IsAMenuItemNamed(menuItemName=menuItemName), recursive)
+        return self.findChild (predicate.IsAMenuItemNamed(menuItemName=menuItemName), recursive, maxDepth=maxDepth)
 
-    def textentry(self, textEntryName, recursive=True):
+    def textentry(self, textEntryName, recursive=True, maxDepth=None):
         """
         Search below this node for a text entry with the given name.
 
@@ -863,9 +1280,9 @@ class Node:
         if no such child is found, and will eventually raise an exception. It
         also logs the search.
         """
-        return self.findChild (predicate.IsATextEntryNamed(textEntryName=textEntryName), recursive)
+        return self.findChild (predicate.IsATextEntryNamed(textEntryName=textEntryName), recursive, maxDepth=maxDepth)
 
-    def button(self, buttonName, recursive=True):
+    def button(self, buttonName, recursive=True, maxDepth=None):
         """
         Search below this node for a button with the given name.
 
@@ -873,9 +1290,9 @@ class Node:
         if no such child is found, and will eventually raise an exception. It
         also logs the search.
         """
-        return self.findChild (predicate.IsAButtonNamed(buttonName=buttonName), recursive)
+        return self.findChild (predicate.IsAButtonNamed(buttonName=buttonName), recursive, maxDepth=maxDepth)
 
-    def childLabelled(self, labelText, recursive=True):
+    def childLabelled(self, labelText, recursive=True, maxDepth=None):
         """
         Search below this node for a child labelled with the given text.
 
@@ -883,9 +1300,9 @@ class Node:
         if no such child is found, and will eventually raise an exception. It
         also logs the search.
         """
-        return self.findChild (predicate.IsLabelledAs(labelText), recursive)
+        return self.findChild (predicate.IsLabelledAs(labelText), recursive, maxDepth=maxDepth)
 
-    def childNamed(self, childName, recursive=True):
+    def childNamed(self, childName, recursive=True, maxDepth=None):
         """
         Search below this node for a child with the given name.
 
@@ -893,9 +1310,9 @@ class Node:
         if no such child is found, and will eventually raise an exception. It
         also logs the search.
         """
-        return self.findChild (predicate.IsNamed(childName), recursive)
+        return self.findChild (predicate.IsNamed(childName), recursive, maxDepth=maxDepth)
 
-    def tab(self, tabName, recursive=True):
+    def tab(self, tabName, recursive=True, maxDepth=None):
         """
         Search below this node for a tab with the given name.
 
@@ -903,7 +1320,7 @@ class Node:
         if no such child is found, and will eventually raise an exception. It
         also logs the search.
         """
-        return self.findChild (predicate.IsATabNamed(tabName=tabName), recursive)
+        return self.findChild (predicate.IsATabNamed(tabName=tabName), recursive, maxDepth=maxDepth)
 
     def getUserVisibleStrings(self):
         """
@@ -956,10 +1373,606 @@ class LinkAnchor:
         return self.link.getURI(self.anchorIndex)
 
 
+class SearchNode(object):
+    """
+    A Node as seen by the search code. Each attribute is read from AT-SPI
+    at most once and then kept, and the reads are counted in
+    SearchNode.calls, so that debug logging can show how many round-trips a
+    search made.
+    """
+    calls = 0
+
+    def __init__(self, node, searchParent = None):
+        self.node = node
+        self.searchParent = searchParent
+
+    def __getattr__(self, name):
+        value = getattr(self.node, name)
+        if not callable(value):
+            SearchNode.calls += 1
+            self.__dict__[name] = value
+        return value
+
+    def __str__(self):
+        return str(self.node)
+
+    def isShowing(self):
+        """
+        Does the node have both the SHOWING and VISIBLE states? The state set
+        is only read the first time this is asked.
+        """
+        showing = self.__dict__.get('_showing')
+        if showing is None:
+            SearchNode.calls += 1
+            showing = isShowing(self.node.getState())
+            self.__dict__['_showing'] = showing
+        return showing
+
+def isShowing(stateSet):
+    """
+    Does the StateSet contain both the SHOWING and VISIBLE states, i.e. is the
+    node actually on screen? Searches with showingOnly set skip the subtrees
+    of nodes for which this is False.
+    """
+    return stateSet.contains(pyatspi.STATE_SHOWING) and \
+            stateSet.contains(pyatspi.STATE_VISIBLE)
+
+def limitChildCount(childCount):
+    """
+    Limit a child count to config.childrenLimit, logging (once) that some
+    children are being left out.
+    """
+    global haveWarnedAboutChildrenLimit
+    if childCount <= config.childrenLimit: return childCount
+    if not haveWarnedAboutChildrenLimit:
+        logger.log("Only returning %s children. You may change "
+            "config.childrenLimit if you wish. This message will only"
+            " be printed once." % str(config.childrenLimit))
+        haveWarnedAboutChildrenLimit = True
+    return config.childrenLimit
+
+def wantsShowingOnly(pred, showingOnly):
+    """
+    Should a search for the predicate skip nodes that aren't showing? An
+    explicit showingOnly argument (if not None) takes precedence over the
+    predicate's own showingOnly attribute.
+    """
+    if showingOnly is None: return getattr(pred, 'showingOnly', False)
+    return showingOnly
+
+def applyCacheLevel():
+    """
+    Turn pyatspi's property cache on if config.cacheProperties is set and this
+    version of pyatspi has one. Otherwise the cache level is left alone, so
+    that one chosen by the script (or the recorder) isn't undone.
+    """
+    if not config.cacheProperties: return
+    setCacheLevel = getattr(pyatspi, 'setCacheLevel', None)
+    if setCacheLevel is None: return
+    if pyatspi.getCacheLevel() != pyatspi.CACHE_PROPERTIES:
+        setCacheLevel(pyatspi.CACHE_PROPERTIES)
+
+
+class SnapshotNode(object):
+    """
+    A copy of the commonly-searched properties of an Accessible, as captured
+    by a TreeSnapshot. Any other attribute is looked up on the live node, so
+    predicates can be run against instances of this class unmodified.
+    """
+    def __init__(self, node, parent = None):
+        self.node = node
+        self.parent = parent
+        self.name = node.name
+        self.roleName = node.roleName
+        self.description = node.description
+        self.states = {}
+        for state in node.getState().getStates():
+            self.states[state] = True
+        self.childCount = node.childCount
+        self.extents = node.extents
+        self.children = []
+
+    def __getattr__(self, name):
+        return getattr(self.node, name)
+
+    def __str__(self):
+        return str(self.node)
+
+    @property
+    def sensitive(self):
+        return self.states.has_key(pyatspi.STATE_SENSITIVE)
+
+    @property
+    def showing(self):
+        return self.states.has_key(pyatspi.STATE_SHOWING)
+
+    @property
+    def focusable(self):
+        return self.states.has_key(pyatspi.STATE_FOCUSABLE)
+
+    @property
+    def focused(self):
+        return self.states.has_key(pyatspi.STATE_FOCUSED)
+
+    @property
+    def isChecked(self):
+        return self.states.has_key(pyatspi.STATE_CHECKED)
+
+    @property
+    def visible(self):
+        return self.states.has_key(pyatspi.STATE_VISIBLE)
+
+
+class TreeSnapshot:
+    """
+    An in-process copy of a subtree of the UI, used to run repeated searches
+    without paying for an AT-SPI round-trip per property per node.
+
+    The subtree is read once, when the snapshot is taken. After that, any
+    children-changed, property-change or state-changed event coming from the
+    same application marks the snapshot as stale, and it is taken again
+    before the next search.
+
+    Searches return the live Node instances, not SnapshotNodes.
+    """
+    invalidatingEvents = ('object:children-changed',
+                          'object:property-change',
+                          'object:state-changed')
+
+    def __init__(self, node):
+        self.node = node
+        try: self.application = node.getApplication()
+        except (AttributeError, NotImplementedError): self.application = None
+        self.root = None
+        self.__events = events.EventQueue(self.invalidatingEvents,
+                self.__affectsSnapshot)
+        self.refresh()
+
+    def __affectsSnapshot(self, event):
+        if self.application is None: return True
+        try: return event.host_application == self.application
+        except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): return True
+
+    def __capture(self, node, parent):
+        snapshotNode = SnapshotNode(node, parent)
+        childCount = min(snapshotNode.childCount, config.childrenLimit)
+        for i in range(childCount):
+            try: child = node[i]
+            except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): child = None
+            if child is None: continue
+            try: snapshotNode.children.append(self.__capture(child, snapshotNode))
+            except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): pass
+        return snapshotNode
+
+    def refresh(self):
+        """
+        Read the subtree again, discarding the old copy.
+        """
+        self.__events.get()
+        self.root = self.__capture(self.node, None)
+        if config.debugSearching:
+            logger.log("Took snapshot of %s" % self.node.getLogString())
+
+    @property
+    def valid(self):
+        """
+        Is the snapshot still an accurate copy of the UI?
+        """
+        if self.root is None: return False
+        if self.__events.get():
+            self.root = None
+            return False
+        return True
+
+    def close(self):
+        """
+        Stop watching for changes. The snapshot can't be refreshed afterwards.
+        """
+        self.__events.close()
+        self.root = None
+
+    def __search(self, pred, recursive, findAll):
+        if not self.valid: self.refresh()
+        showingOnly = wantsShowingOnly(pred, None)
+        result = []
+        stack = list(reversed(self.root.children))
+        while stack:
+            snapshotNode = stack.pop()
+            if showingOnly and not (snapshotNode.showing and \
+                    snapshotNode.visible): continue
+            if pred.satisfiedByNode(snapshotNode):
+                result.append(snapshotNode.node)
+                if not findAll: break
+            if recursive: stack.extend(reversed(snapshotNode.children))
+        return result
+
+    def findChild(self, pred, recursive = True, debugName = None, \
+            retry = True, requireResult = True):
+        """
+        Search the snapshot for a node satisfying the predicate, returning
+        the live Node. Retries (refreshing the snapshot if it went stale) and
+        fails in the same way as Node.findChild.
+        """
+        assert isinstance(pred, predicate.Predicate)
+        if debugName is None: debugName = pred.describeSearchResult()
+        if recursive: noun = "descendent"
+        else: noun = "child"
+        description = "%s of snapshot of %s: %s" % (noun,
+                self.node.getLogString(), debugName)
+        numAttempts = 0
+        while numAttempts < config.searchCutoffCount:
+            if numAttempts >= config.searchWarningThreshold or config.debugSearching:
+                logger.log("searching for %s (attempt %i)" % \
+                        (description, numAttempts))
+            result = self.__search(pred, recursive, False)
+            if result:
+                result = result[0]
+                result.debugName = debugName
+                return result
+            if not retry: break
+            numAttempts += 1
+            if config.debugSearching or config.debugSleep:
+                logger.log("sleeping for %f" % config.searchBackoffDuration)
+            sleep(config.searchBackoffDuration)
+        if requireResult:
+            raise SearchError(description)
+
+    def findChildren(self, pred, recursive = True):
+        """
+        Find all nodes in the snapshot satisfying the predicate, returning the
+        live Nodes.
+        """
+        assert isinstance(pred, predicate.Predicate)
+        return self.__search(pred, recursive, True)
+
+    def child(self, name = '', roleName = '', description= '', label = '', recursive=True, debugName=None):
+        """
+        Finds a child satisying the given criteria, like Node.child.
+        """
+        return self.findChild(predicate.GenericPredicate(name = name, roleName = roleName, description= description, label = label), recursive = recursive, debugName=debugName)
+
+
+class SearchIndex:
+    """
+    An index of the nodes of an application by roleName and name, used to
+    answer searches for predicates that declare Predicate.indexKeys()
+    without walking the whole tree.
+
+    The index is built by walking the application once. After that it is
+    kept up to date from children-changed and accessible-name change events:
+    a removed node is dropped along with its whole subtree, and a renamed one
+    moved to its new name. Entries are never trusted blindly: every candidate
+    is checked against the predicate before being returned, so entries for
+    nodes that changed unannounced are simply skipped.
+    """
+    watchedEvents = ('object:children-changed',
+                     'object:property-change:accessible-name')
+
+    def __init__(self, application):
+        self.application = application
+        self.__byRole = {}
+        # The key each node is indexed under, and the children it had when
+        # it was indexed, so that entries can be removed without asking the
+        # (possibly dead) node.
+        self.__keys = {}
+        self.__children = {}
+        self.__events = events.EventQueue(self.watchedEvents,
+                self.__isFromApplication)
+        self.__addSubtree(application, checkDuplicates = False)
+        if config.debugSearching:
+            logger.log("Built search index of %s" % application.getLogString())
+
+    def __isFromApplication(self, event):
+        try: return event.host_application == self.application
+        except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): return False
+
+    def __key(self, node):
+        return (node.roleName, i18n.safeDecode(node.name))
+
+    def __add(self, node, checkDuplicates = True):
+        key = self.__key(node)
+        if checkDuplicates:
+            if self.__keys.get(node) == key: return
+            self.__remove(node)
+        roleName, name = key
+        bucket = self.__byRole.setdefault(roleName, {}).setdefault(name, [])
+        bucket.append(node)
+        self.__keys[node] = key
+
+    def __remove(self, node):
+        key = self.__keys.pop(node, None)
+        if key is None: return
+        roleName, name = key
+        try: self.__byRole[roleName][name].remove(node)
+        except (KeyError, ValueError): pass
+
+    def __removeSubtree(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            self.__remove(node)
+            stack.extend(self.__children.pop(node, []))
+
+    def __addSubtree(self, node, parent = None, checkDuplicates = True):
+        if parent is not None:
+            children = self.__children.setdefault(parent, [])
+            if node not in children: children.append(node)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            try:
+                self.__add(node, checkDuplicates)
+                children = []
+                for i in range(node.childCount):
+                    child = node[i]
+                    if child is not None: children.append(child)
+                self.__children[node] = children
+                children = list(children)
+                children.reverse()
+                stack.extend(children)
+            except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): pass
+
+    def update(self):
+        """
+        Apply any changes announced by AT-SPI events since the last update.
+        """
+        for event in self.__events.get():
+            try:
+                if event.type.major == 'children-changed':
+                    if event.type.minor == 'add':
+                        self.__addSubtree(event.any_data, event.source)
+                    elif event.type.minor == 'remove':
+                        self.__removeSubtree(event.any_data)
+                        children = self.__children.get(event.source)
+                        if children and event.any_data in children:
+                            children.remove(event.any_data)
+                else:
+                    self.__add(event.source)
+            except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): pass
+
+    def lookup(self, keys):
+        """
+        Get the nodes indexed under any of the given (roleName, name) pairs,
+        as returned by Predicate.indexKeys().
+        """
+        self.update()
+        result = []
+        for roleName, name in keys:
+            names = self.__byRole.get(roleName, {})
+            if name is None:
+                for bucket in names.values(): result.extend(bucket)
+            else: result.extend(names.get(name, []))
+        return result
+
+    def __positionBelow(self, node, candidate, maxDepth = None,
+            showingOnly = False):
+        """
+        Get the indexes in their parents of the candidate and its ancestors
+        up to (but not including) the given node, from the top down, or None
+        if the candidate isn't below that node (by no more than maxDepth
+        levels). If showingOnly is True, None is also returned if any of
+        those nodes isn't showing, since a walk would have skipped it.
+        """
+        position = []
+        while candidate != node:
+            if maxDepth is not None and len(position) >= maxDepth: return None
+            if showingOnly and not isShowing(candidate.getState()):
+                return None
+            parent = candidate.parent
+            if parent is None: return None
+            position.append(candidate.indexInParent)
+            candidate = parent
+        position.reverse()
+        return position
+
+    def find(self, node, pred, recursive = True, maxDepth = None,
+            showingOnly = None, order = 'dfs'):
+        """
+        Generate the nodes below the given node (which must belong to this
+        index's application, and be no more than maxDepth levels down) that
+        satisfy the predicate, and are showing along with all of their
+        ancestors below the given node if showingOnly asks for that, in the
+        order that walking the tree in the given order (see
+        Node._iterSearch) would find them.
+
+        Putting the nodes in order means finding the position of every match
+        before the first is generated. If order is None, each match is
+        generated as soon as it is found instead, in whatever order the index
+        holds them, which suits callers that only want one.
+        """
+        showingOnly = wantsShowingOnly(pred, showingOnly)
+        if config.debugSearching:
+            logger.log("looking up %s in search index" % \
+                    pred.describeSearchResult())
+        if not recursive: maxDepth = 1
+        found = []
+        seen = {}
+        for candidate in self.lookup(pred.indexKeys()):
+            try:
+                if seen.has_key(candidate): continue
+                seen[candidate] = True
+                if not pred.satisfiedByNode(candidate): continue
+                position = self.__positionBelow(node, candidate, maxDepth,
+                        showingOnly)
+            except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): continue
+            if position is None: continue
+            if order is None: yield candidate
+            # Depth-first walks find nodes in document order; the other
+            # strategies find shallower nodes first.
+            elif order == 'dfs': found.append((position, candidate))
+            else: found.append(((len(position), position), candidate))
+        found.sort(key = lambda item: item[0])
+        for key, candidate in found: yield candidate
+
+    def close(self):
+        """
+        Stop keeping the index up to date, and stop using it for searches.
+        """
+        self.__events.close()
+        if self in searchIndexes: searchIndexes.remove(self)
+
+# The SearchIndex instances built so far, one per application.
+searchIndexes = []
+
+class SearchPathCache:
+    """
+    The SearchPaths computed by Node.getAbsoluteSearchPath, keyed by node.
+
+    Each path is recorded along with the nodes it was derived from: the node
+    itself, any unidentifiable ancestors skipped over by its relative search,
+    and the ancestor that search starts from (whose own path is the prefix of
+    this one). When AT-SPI events announce that one of those nodes was
+    renamed or moved, or gained a child (which might now match the same
+    search), the path is dropped, along with the paths that were derived from
+    it in turn.
+
+    The cache only listens for events while it holds paths, and only keeps
+    those coming from the applications the cached nodes belong to.
+    """
+    watchedEvents = ('object:children-changed',
+                     'object:property-change:accessible-name',
+                     'object:property-change:accessible-parent')
+
+    def __init__(self):
+        self.__paths = {}
+        self.__dependents = {}
+        # The applications of the cached nodes; None stands for nodes whose
+        # application couldn't be found, and lets every event through.
+        self.__applications = {}
+        self.__events = None
+
+    def __affectsPaths(self, event):
+        if self.__applications.has_key(None): return True
+        try: return self.__applications.has_key(event.host_application)
+        except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): return True
+
+    def __stopListening(self):
+        if self.__events is not None:
+            self.__events.close()
+            self.__events = None
+        self.__applications.clear()
+
+    def update(self):
+        """
+        Drop the paths invalidated by AT-SPI events since the last update.
+        """
+        if self.__events is None: return
+        for event in self.__events.get():
+            try:
+                if event.type.major == 'children-changed':
+                    if event.type.minor == 'remove':
+                        self.invalidate(event.any_data)
+                    else:
+                        # A new sibling may match the searches of the
+                        # paths that start from (or pass over) the parent.
+                        self.invalidate(event.source)
+                else:
+                    self.invalidate(event.source)
+            except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): pass
+            if self.__events is None: return
+
+    def get(self, node):
+        """
+        Get the cached SearchPath of the node, or None.
+        """
+        self.update()
+        try: return self.__paths.get(node)
+        except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): return None
+
+    def add(self, node, searchPath, pathNodes):
+        """
+        Cache the SearchPath of the node, which stays valid for as long as
+        none of pathNodes is renamed or moved.
+        """
+        try:
+            application = node.getApplication()
+            if application is None and node.roleName == 'application':
+                application = node
+        except (NotImplementedError, LookupError, COMM_FAILURE,
+                OBJECT_NOT_EXIST):
+            application = None
+        try:
+            self.__paths[node] = searchPath
+            for pathNode in pathNodes:
+                self.__dependents.setdefault(pathNode, []).append(node)
+        except (LookupError, COMM_FAILURE, OBJECT_NOT_EXIST): return
+        self.__applications[application] = True
+        if self.__events is None:
+            self.__events = events.EventQueue(self.watchedEvents,
+                    self.__affectsPaths)
+
+    def invalidate(self, node):
+        """
+        Drop the cached path of the node, and of every node whose path was
+        derived from it.
+        """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if self.__paths.has_key(node): del self.__paths[node]
+            stack.extend(self.__dependents.pop(node, []))
+        if not self.__paths: self.clear()
+
+    def clear(self):
+        """
+        Drop all cached paths, and stop listening for events until a path is
+        cached again.
+        """
+        self.__paths.clear()
+        self.__dependents.clear()
+        self.__stopListening()
+
+    def close(self):
+        """
+        Stop keeping the cache up to date, and stop using it.
+        """
+        global searchPathCache
+        self.clear()
+        if searchPathCache is self: searchPathCache = None
+
+searchPathCache = None
+
+def getSearchPathCache():
+    """
+    Get the SearchPathCache, creating it if needed.
+    """
+    global searchPathCache
+    if searchPathCache is None: searchPathCache = SearchPathCache()
+    return searchPathCache
+
+def getSearchIndex(application):
+    """
+    Get the SearchIndex for the given application, building it if needed.
+    """
+    for index in searchIndexes:
+        if index.application == application: return index
+    index = SearchIndex(application)
+    searchIndexes.append(index)
+    return index
+
+
 class Root (Node):
     """
     FIXME:
     """
+    haveCheckedForApplications = False
+
+    def iterChildren(self, limit = False):
+        """
+        As Node.iterChildren, but the first time the desktop's children have
+        all been listed, warn if there are none. This is done here rather than
+        when dogtail.tree is imported, so that scripts which never look at the
+        desktop don't pay for listing it.
+        """
+        count = 0
+        for child in Node.iterChildren(self, limit):
+            count += 1
+            yield child
+        if not Root.haveCheckedForApplications:
+            Root.haveCheckedForApplications = True
+            # Check that there are applications running. Warn if none are.
+            if not count:
+                logger.log("Warning: AT-SPI's desktop is visible but it has no children. Are you running any AT-SPI-aware applications?")
     def applications(self):
         """
         Get all applications.
@@ -979,7 +1992,7 @@ class Root (Node):
         return root.findChild(predicate.IsAnApplicationNamed(appName),recursive=False)
 
 class Application (Node):
-    def dialog(self, dialogName, recursive=False):
+    def dialog(self, dialogName, recursive=False, maxDepth=None):
         """
         Search below this node for a dialog with the given name,
         returning a Window instance.
@@ -990,9 +2003,9 @@ class Application (Node):
 
         FIXME: should this method activate the dialog?
         """
-        return self.findChild(predicate.IsADialogNamed(dialogName=dialogName), recursive)
+        return self.findChild(predicate.IsADialogNamed(dialogName=dialogName), recursive, maxDepth=maxDepth)
 
-    def window(self, windowName, recursive=False):
+    def window(self, windowName, recursive=False, maxDepth=None):
         """
         Search below this node for a window with the given name,
         returning a Window instance.
@@ -1005,9 +2018,9 @@ class Application (Node):
         The window will be automatically activated (raised and focused
         by the window manager) if wnck bindings are available.
         """
-        result = self.findChild (predicate.IsAWindowNamed(windowName=windowName), recursive)
+        result = self.findChild (predicate.IsAWindowNamed(windowName=windowName), recursive, maxDepth=maxDepth)
         # FIXME: activate the WnckWindow ?
-        #if gotWnck:
+        #if importWnck():
         #       result.activate()
         return result
 
@@ -1035,6 +2048,8 @@ class Window (Node):
         Get the wnck.Window instance for this window, or None
         """
         # FIXME: this probably needs rewriting:
+        wnck = importWnck()
+        if wnck is None: return None
         screen = wnck.screen_get_default()
 
         # You have to force an update before any of the wnck methods
@@ -1141,11 +2156,8 @@ except Exception:
     # Warn if AT-SPI's desktop object doesn't show up.
     logger.log("Error: AT-SPI's desktop is not visible. Do you have accessibility enabled?")
 
-# Check that there are applications running. Warn if none are.
-children = root.children
-if not children:
-    logger.log("Warning: AT-SPI's desktop is visible but it has no children. Are you running any AT-SPI-aware applications?")
-del children
+# Whether there are applications running is checked (and warned about) the
+# first time the desktop's children are listed; see Root.iterChildren.
 
 # Convenient place to set some debug variables:
 #config.debugSearching = True
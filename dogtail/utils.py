@@ -14,24 +14,103 @@ import os
 import sys
 import subprocess
 import re
+import threading
 from config import config
 from time import sleep
 from logging import debugLogger as logger
 from logging import TimeStamp
 from errors import DependencyNotFoundError
+import metrics
 
-def screenshot(file = 'screenshot.png', timeStamp = True):
+# Whether GDK has been told that it is used from more than one thread, after
+# which every use of gtk.gdk has to hold the GDK lock; see gdkLocked.
+gdkThreadsEnabled = False
+gdkLockDepth = threading.local()
+
+def enableGdkThreads():
+    """
+    Make GDK safe to use from more than one thread, such as the
+    dogtail.capture recorder's. From then on, the functions that use gtk.gdk
+    take the GDK lock (see gdkLocked). Must be called before any other thread
+    uses GDK.
     """
-    This function wraps the ImageMagick import command to take a screenshot.
+    global gdkThreadsEnabled
+    if gdkThreadsEnabled: return
+    import gtk.gdk
+    gtk.gdk.threads_init()
+    gdkThreadsEnabled = True
+
+def gdkLocked(function):
+    """
+    Decorator for functions that use gtk.gdk, making them hold the GDK lock
+    once enableGdkThreads() has been called. The lock isn't recursive, so
+    only the outermost of nested calls takes it. Functions that iterate the
+    main context (e.g. dogtail.events.pump) must not be called while it is
+    held, as GDK takes it itself to dispatch events.
+    """
+    def locked(*args, **kwargs):
+        if not gdkThreadsEnabled: return function(*args, **kwargs)
+        depth = getattr(gdkLockDepth, 'value', 0)
+        if depth: return function(*args, **kwargs)
+        import gtk.gdk
+        gtk.gdk.threads_enter()
+        gdkLockDepth.value = 1
+        try: return function(*args, **kwargs)
+        finally:
+            gdkLockDepth.value = 0
+            gtk.gdk.threads_leave()
+    locked.__name__ = function.__name__
+    locked.__doc__ = function.__doc__
+    return locked
+
+@gdkLocked
+def grabRegion(region = None):
+    """
+    Grab the given (x, y, w, h) region of the root window, or all of it if
+    region is None, into a gtk.gdk.Pixbuf. The region is clipped to the
+    screen; ValueError is raised if nothing of it is left.
+    """
+    import gtk.gdk
+    rootWindow = gtk.gdk.get_default_root_window()
+    geometry = rootWindow.get_geometry()
+    if region is None: region = (0, 0, geometry[2], geometry[3])
+    (x, y, w, h) = region
+    left = max(x, 0)
+    top = max(y, 0)
+    right = min(x + w, geometry[2])
+    bottom = min(y + h, geometry[3])
+    if right <= left or bottom <= top:
+        raise ValueError, "Region %s is not on the screen" % (region,)
+    pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, right - left, \
+            bottom - top)
+    gtk.gdk.Pixbuf.get_from_drawable(pixbuf, rootWindow, \
+            rootWindow.get_colormap(), left, top, 0, 0, right - left, \
+            bottom - top)
+    return pixbuf
+
+@gdkLocked
+def screenshot(file = 'screenshot.png', timeStamp = True, region = None,
+        inMemory = False):
+    """
+    This function takes a screenshot of the root window.
 
     The file argument may be specified as 'foo', 'foo.png', or using any other
-    extension that ImageMagick supports. PNG is the default.
+    extension that gtk.gdk.Pixbuf can save. PNG is the default.
 
     By default, screenshot filenames are in the format of foo_YYYYMMDD-hhmmss.png .
     The timeStamp argument may be set to False to name the file foo.png.
+
+    region may be an (x, y, w, h) tuple, such as a Node's extents, to capture
+    only that part of the screen. If inMemory is True, nothing is saved and
+    the gtk.gdk.Pixbuf itself is returned instead of a path; it can be passed
+    straight to dogtail.tc.TCImage.compare().
     """
     if not isinstance(timeStamp, bool):
         raise TypeError, "timeStampt must be True or False"
+    if inMemory:
+        pixbuf = grabRegion(region)
+        logger.log("Screenshot taken in memory")
+        return pixbuf
     # config is supposed to create this for us. If it's not there, bail.
     assert os.path.isdir(config.scratchDir)
 
@@ -49,14 +128,8 @@ def screenshot(file = 'screenshot.png', timeStamp = True):
         newFile = baseName + '.' + fileExt
         path = config.scratchDir + newFile
 
-    import gtk.gdk
     import gobject
-    rootWindow = gtk.gdk.get_default_root_window()
-    geometry = rootWindow.get_geometry()
-    pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8, geometry[2], \
-            geometry[3])
-    gtk.gdk.Pixbuf.get_from_drawable(pixbuf, rootWindow, \
-            rootWindow.get_colormap(), 0, 0, 0, 0, geometry[2], geometry[3])
+    pixbuf = grabRegion(region)
     # gtk.gdk.Pixbuf.save() needs 'jpeg' and not 'jpg'
     if fileExt == 'jpg': fileExt = 'jpeg'
     try: pixbuf.save(path, fileExt)
@@ -66,6 +139,7 @@ def screenshot(file = 'screenshot.png', timeStamp = True):
     logger.log("Screenshot taken: " + path)
     return path
 
+@metrics.timed('utils.run')
 def run(string, timeout=config.runTimeout, interval=config.runInterval, desktop=None, dumb=False, appName=''):
     """
     Runs an application. [For simple command execution such as 'rm *', use os.popen() or os.system()]
@@ -103,13 +177,43 @@ def run(string, timeout=config.runTimeout, interval=config.runInterval, desktop=
             doDelay(interval)
     return pid
 
-def doDelay(delay=None):
+# The total time adaptive delays have saved, compared to sleeping, or None
+# before the first adaptive delay.
+delayTimeSaved = None
+
+def logDelayTimeSaved():
+    logger.log("Adaptive delays saved %f seconds in total" % delayTimeSaved)
+
+@metrics.timed('utils.delay')
+def doDelay(delay=None, node=None):
     """
     Utility function to insert a delay (with logging and a configurable
     default delay)
+
+    With config.adaptiveDelays set, the delay ends early once the application
+    stops sending AT-SPI events; node may be any Node of the application that
+    was acted on, otherwise all applications are waited on.
     """
     if delay is None:
         delay = config.defaultDelay
+    if config.adaptiveDelays:
+        global delayTimeSaved
+        import events
+        application = None
+        if node is not None:
+            try: application = node.getApplication()
+            except Exception: pass
+        if delayTimeSaved is None:
+            import atexit
+            atexit.register(logDelayTimeSaved)
+            delayTimeSaved = 0.0
+        waited = events.getIdleMonitor().waitForQuiet(delay,
+                config.quietPeriod, application)
+        delayTimeSaved += max(0, delay - waited)
+        if config.debugSleep:
+            logger.log("waited %f of %f for the application to go quiet" % \
+                    (waited, delay))
+        return
     if config.debugSleep:
         logger.log("sleeping for %f" % delay)
     sleep(delay)
@@ -126,8 +230,18 @@ class Blinker:
         self.w = w
         self.h = h
         self.timeout_handler_id = gobject.timeout_add (Blinker.INTERVAL_MS, self.blinkDrawRectangle)
-        gtk.main()
+        self.runMainLoop()
+
+    def runMainLoop(self):
+        # gtk.main() expects the GDK lock to be held, and releases it while
+        # it runs, so the timeout has to take it again.
+        import gtk
+        if not gdkThreadsEnabled: return gtk.main()
+        gtk.gdk.threads_enter()
+        try: gtk.main()
+        finally: gtk.gdk.threads_leave()
 
+    @gdkLocked
     def blinkDrawRectangle (self):
         import gtk.gdk
         display = gtk.gdk.display_get_default()
@@ -19,6 +19,8 @@ import time
 import dogtail.tree
 import dogtail.predicate
 import dogtail.config
+import dogtail.rawinput
+import dogtail.tc
 dogtail.config.config.logDebugToFile = False
 import pyatspi
 from CORBA import COMM_FAILURE
@@ -117,6 +119,16 @@ class TestNodeAttributes(GtkDemoTest):
         self.assertEquals(kids[0].name, "GTK+ Code Demos")
         self.assertEquals(kids[0].roleName, "frame")
 
+    def testGetChildAttributes(self):
+        "Node.getChildAttributes should agree with the children's own attributes."
+        attributes = self.app.getChildAttributes()
+        self.assertEquals(len(attributes), 1)
+        child, values = attributes[0]
+        self.assertEquals(values['name'], "GTK+ Code Demos")
+        self.assertEquals(values['roleName'], "frame")
+        self.assertEquals(values['childCount'], child.childCount)
+        self.assert_(pyatspi.STATE_SHOWING in values['states'])
+
     def testSetChildren(self):
         "Node.children should be read-only"
         self.assertRaises(AttributeError, self.app.__setattr__,  "children", [])
@@ -161,6 +173,53 @@ class TestNodeAttributes(GtkDemoTest):
         # FIXME: should we assert that things are logged and delays are added?
         # FIXME: should have a test case involving the complex GtkTextView widget
 
+    def testBulkTyping(self):
+        "Ensure that bulk typing enters the same text as typing key by key"
+        self.runDemo('Dialog and Message Boxes')
+        wnd = self.app.window('Dialogs')
+        wnd.button('Interactive Dialog').click()
+        dlg = self.app.dialog('Interactive Dialog')
+        entry1 = dlg.child(label='Entry 1')
+        entry2 = dlg.child(label='Entry 2')
+
+        entry1.typeText("hello world")
+        dogtail.config.config.bulkTyping = True
+        try:
+            entry2.typeText("hello world")
+            entry2.grabFocus()
+            dogtail.rawinput.typeText(" again")
+        finally:
+            dogtail.config.config.bulkTyping = False
+        self.assertEquals(entry1.text, "hello world")
+        self.assertEquals(entry2.text, "hello world again")
+
+    def testBulkTypingUnicode(self):
+        "Ensure that bulk typing counts non-ASCII text in characters"
+        self.runDemo('Dialog and Message Boxes')
+        wnd = self.app.window('Dialogs')
+        entry1 = wnd.child(label='Entry 1')
+        dogtail.config.config.bulkTyping = True
+        try:
+            entry1.typeText("h\xc3\xa9llo")
+            entry1.typeText(" w\xc3\xb6rld")
+        finally:
+            dogtail.config.config.bulkTyping = False
+        self.assertEquals(entry1.text, "h\xc3\xa9llo w\xc3\xb6rld")
+        self.assertEquals(entry1.caretOffset, 11)
+
+    def testScreenshot(self):
+        "Ensure that a node's screenshot covers just its extents"
+        self.runDemo('Dialog and Message Boxes')
+        wnd = self.app.window('Dialogs')
+        button = wnd.button('Interactive Dialog')
+        pixbuf = button.screenshot(inMemory = True)
+        (x, y, w, h) = button.extents
+        self.assertEquals((pixbuf.get_width(), pixbuf.get_height()), (w, h))
+        case = dogtail.tc.TCImage()
+        result = case.compare('screenshot', pixbuf,
+                button.screenshot(inMemory = True))
+        self.assertEquals(result, {'screenshot': 'Passed'})
+
     def testCaretOffset(self):
         "Make sure the caret offset works as expected"
         self.runDemo('Dialog and Message Boxes')
@@ -439,6 +498,128 @@ class TestSearching(GtkDemoTest):
         # 318 is a magic number. I did verify this.
         self.assertEquals(len(cells), 318)
 
+    def testFindChildrenLimit(self):
+        "Ensure that findChildren stops once it has found limit nodes."
+        pred = dogtail.predicate.GenericPredicate(roleName = 'table cell')
+        tableCells = self.app.findChildren(pred, limit = 5)
+        self.assertEquals(len(tableCells), 5)
+        self.assertEquals(tableCells, self.app.findChildren(pred)[:5])
+
+    def testSearchPastChildrenLimit(self):
+        "Ensure that searches find children past config.childrenLimit."
+        table = self.app.child(roleName = 'tree table')
+        pred = dogtail.predicate.GenericPredicate(roleName = 'table cell')
+        cells = table.findChildren(pred, recursive = False)
+        original = dogtail.config.config.childrenLimit
+        try:
+            dogtail.config.config.childrenLimit = 5
+            self.assertEquals(len(table.children), 5)
+            self.assertEquals(table.findChildren(pred, recursive = False),
+                    cells)
+            names = [cell.name for cell in cells]
+            first = cells[names.index(cells[-1].name)]
+            self.assertEquals(table.findChild(
+                    dogtail.predicate.IsNamed(first.name), recursive = False,
+                    retry = False), first)
+        finally:
+            dogtail.config.config.childrenLimit = original
+
+    def testIterDescendants(self):
+        "Ensure that both traversal orders see the same nodes."
+        dfs = list(self.app.iterDescendants(maxDepth = 3))
+        bfs = list(self.app.iterDescendants(order = 'bfs', maxDepth = 3))
+        self.assertEquals(len(dfs), len(bfs))
+        self.assertEquals(bfs[0], self.app.children[0])
+        self.assertEquals(list(self.app.iterChildren()), self.app.children)
+        self.assertRaises(ValueError, self.app.iterDescendants, None, 'random')
+
+    def testSearchStrategies(self):
+        "Ensure that every search strategy finds the same node."
+        original = dogtail.config.config.searchStrategy
+        try:
+            for strategy in ('dfs', 'bfs', 'iterative-deepening'):
+                dogtail.config.config.searchStrategy = strategy
+                self.assertEquals(self.app.child('Source').roleName, 'page tab')
+        finally:
+            dogtail.config.config.searchStrategy = original
+
+    def testMaxDepth(self):
+        "Ensure that maxDepth keeps searches from going too deep."
+        self.assertEquals(self.app.child(roleName = 'frame',
+            maxDepth = 1).name, "GTK+ Code Demos")
+        self.assertEquals(self.app.findChild(
+            dogtail.predicate.GenericPredicate(roleName = 'table cell'),
+            maxDepth = 2, retry = False, requireResult = False), None)
+
+    def testShowingOnly(self):
+        "Ensure that showingOnly skips subtrees that aren't on screen."
+        pred = dogtail.predicate.GenericPredicate(roleName = 'table cell')
+        showing = self.app.findChildren(pred, showingOnly = True)
+        self.assert_(len(showing) <= 41)
+        for node in showing: self.assert_(node.showing)
+        pred = dogtail.predicate.GenericPredicate(roleName = 'page tab',
+                name = 'Source', showingOnly = True)
+        self.assertEquals(self.app.findChild(pred).name, 'Source')
+
+    def testSnapshotFindChildren(self):
+        "Ensure that a snapshot finds the same table cells as a live search."
+        pred = dogtail.predicate.GenericPredicate(roleName = 'table cell')
+        snapshot = self.app.snapshot()
+        self.assertEquals(len(snapshot.findChildren(pred)), 41)
+        self.assert_(snapshot.valid)
+        snapshot.close()
+
+    def testCachedSearchPaths(self):
+        "Ensure that cached search paths match freshly computed ones."
+        node = self.app.child(roleName = 'page tab', name = 'Source')
+        expected = str(node.getAbsoluteSearchPath())
+        dogtail.config.config.cacheSearchPaths = True
+        try:
+            first = node.getAbsoluteSearchPath()
+            second = node.getAbsoluteSearchPath()
+            self.assertEquals(str(first), expected)
+            self.assertEquals(str(second), expected)
+            # Callers get their own copy to append to:
+            self.failIf(first is second)
+            first.append(dogtail.predicate.IsNamed('foo'), False)
+            self.assertEquals(str(node.getAbsoluteSearchPath()), expected)
+        finally:
+            dogtail.config.config.cacheSearchPaths = False
+            dogtail.tree.getSearchPathCache().close()
+
+    def testResolveSearchPath(self):
+        "Ensure that a search path resolves back to its node."
+        node = self.app.child(roleName = 'page tab', name = 'Source')
+        searchPath = node.getAbsoluteSearchPath()
+        self.assertEquals(searchPath.resolve(dogtail.tree.root), node)
+        # The prefix was cached along the way:
+        prefix = searchPath.getPrefix(searchPath.length() - 1)
+        self.assertEquals(prefix.resolve(dogtail.tree.root), node.parent)
+        self.assertEquals(searchPath.resolve(dogtail.tree.root), node)
+
+    def testSearchIndex(self):
+        "Ensure that searching through the index finds the same nodes."
+        pred = dogtail.predicate.GenericPredicate(roleName = 'table cell')
+        dogtail.config.config.useSearchIndex = True
+        try:
+            self.assertEquals(len(self.app.findChildren(pred)), 41)
+            self.assertEquals(self.app.child(roleName = 'page tab',
+                name = 'Source').name, 'Source')
+        finally:
+            dogtail.config.config.useSearchIndex = False
+            index = dogtail.tree.getSearchIndex(self.app)
+            index.close()
+
+    def testEventDrivenSearch(self):
+        "Ensure that waiting for events finds a window opened after the search starts."
+        dogtail.config.config.eventDrivenSearch = True
+        try:
+            self.runDemo('Dialog and Message Boxes')
+            wnd = self.app.window('Dialogs')
+            self.assertEquals(wnd.roleName, 'frame')
+        finally:
+            dogtail.config.config.eventDrivenSearch = False
+
 
 class TestActions(GtkDemoTest):
     # FIXME: should test the various actions
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""
+Import-time benchmark for the dogtail modules.
+
+Imports each module in a fresh interpreter a number of times, and prints the
+best wall-clock time along with which of the heavy bindings (GTK+, PIL,
+libwnck, pyatspi) the import pulled in. Modules that don't need a binding
+shouldn't load it.
+
+Usage: python tests/importtime.py [-n RUNS] [module ...]
+"""
+
+import os
+import sys
+import time
+import getopt
+import subprocess
+
+defaultModules = ('dogtail.config', 'dogtail.logging', 'dogtail.utils',
+        'dogtail.tc', 'dogtail.i18n', 'dogtail.rawinput', 'dogtail.tree',
+        'dogtail.procedural')
+
+heavyModules = ('gtk', 'PIL', 'wnck', 'pyatspi')
+
+# Run in the child interpreter; prints the heavy modules that got loaded.
+probe = """
+import sys
+import %s
+print ' '.join([name for name in %r if name in sys.modules])
+"""
+
+def timeImport(module, runs):
+    """
+    Return the best time of the given number of runs, in seconds, and the
+    heavy modules loaded by importing the module.
+    """
+    env = dict(os.environ)
+    topDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([topDir, env.get('PYTHONPATH', '')])
+    best = None
+    loaded = ''
+    for run in range(runs):
+        start = time.time()
+        child = subprocess.Popen([sys.executable, '-c',
+            probe % (module, heavyModules)], env = env,
+            stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        output = child.communicate()[0]
+        elapsed = time.time() - start
+        if child.returncode != 0: return None, 'import failed'
+        if best is None or elapsed < best: best = elapsed
+        loaded = output.strip()
+    return best, loaded
+
+def main():
+    runs = 5
+    opts, modules = getopt.getopt(sys.argv[1:], 'n:')
+    for opt, value in opts:
+        if opt == '-n': runs = int(value)
+    if not modules: modules = defaultModules
+
+    baseline = timeImport('os', runs)[0]
+    print "%-20s %10s  %s" % ('module', 'ms', 'heavy modules loaded')
+    print "%-20s %10.1f" % ('(interpreter)', baseline * 1000)
+    for module in modules:
+        elapsed, loaded = timeImport(module, runs)
+        if elapsed is None:
+            print "%-20s %10s  %s" % (module, '-', loaded)
+        else:
+            print "%-20s %10.1f  %s" % (module, (elapsed - baseline) * 1000,
+                    loaded)
+
+if __name__ == '__main__':
+    main()